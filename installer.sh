@@ -58,12 +58,12 @@ print_success "Репозиторий успешно склонирован."
 print_info "Настройка Python окружения и установка зависимостей..."
 # Создаем и записываем правильный requirements.txt
 cat << EOF > python_api/requirements.txt
-TikTokApi
+TikTokApi>=7.3,<8
 fastapi==0.111.0
 uvicorn==0.30.1
 python-dotenv==1.0.1
 playwright==1.44.0
-httpx==0.27.0
+httpx[http2]==0.27.0
 shazamio
 opencv-python-headless
 yt-dlp
@@ -56,10 +56,12 @@ bot.on('message', async (msg) => {
 
         try {
             const response = await axios.get(`${API_INTERNAL_URL}/video_data`, { params: { original_url: tiktokUrl }, timeout: 180000 });
-            const { metadata, videoBase64, videoFilePath, image_paths } = response.data;
+            const { metadata, videoUrl, videoBase64, videoFilePath, image_paths, images } = response.data;
             
             if (image_paths && image_paths.length > 0) {
-                await bot.editMessageText(`✅ Данные получены. Скачиваю ${image_paths.length} фото...`, { chat_id: chatId, message_id: waitingMsg.message_id });
+                const failedCount = (images || []).filter((image) => image.status !== 'ok').length;
+                const failedNote = failedCount > 0 ? ` (не удалось скачать: ${failedCount})` : '';
+                await bot.editMessageText(`✅ Данные получены. Скачиваю ${image_paths.length} фото${failedNote}...`, { chat_id: chatId, message_id: waitingMsg.message_id });
                 let rawDesc = metadata.desc || '';
                 const header = `<b>Автор:</b> @${escapeHTML(metadata.author?.uniqueId || '')}\n`;
                 const stats = metadata.stats || {};
@@ -97,7 +99,12 @@ bot.on('message', async (msg) => {
                 await bot.deleteMessage(chatId, waitingMsg.message_id);
                 let sentVideoMsg;
                 await bot.sendChatAction(chatId, 'upload_video');
-                if (videoFilePath) sentVideoMsg = await bot.sendVideo(chatId, videoFilePath, { caption: '​', reply_to_message_id: msg.message_id });
+                if (videoUrl) {
+                    // Видео читаем потоком из API, не держа весь файл в памяти
+                    const videoStream = await axios.get(`${API_INTERNAL_URL}${videoUrl}`, { responseType: 'stream' });
+                    sentVideoMsg = await bot.sendVideo(chatId, videoStream.data, { caption: '​', reply_to_message_id: msg.message_id }, { filename: `${metadata.id || 'video'}.mp4`, contentType: 'video/mp4' });
+                }
+                else if (videoFilePath) sentVideoMsg = await bot.sendVideo(chatId, videoFilePath, { caption: '​', reply_to_message_id: msg.message_id });
                 else if (videoBase64) sentVideoMsg = await bot.sendVideo(chatId, Buffer.from(videoBase64, 'base64'), { caption: '​', reply_to_message_id: msg.message_id });
                 else throw new Error("API не вернул ни видео, ни фотоальбом.");
                 
@@ -1,41 +1,43 @@
 # python_api/api.py
 
-from fastapi import FastAPI, HTTPException, Request, Response
-from fastapi.responses import JSONResponse, HTMLResponse, FileResponse
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import JSONResponse, HTMLResponse, PlainTextResponse, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
 from contextlib import asynccontextmanager
+from pydantic import BaseModel
 import asyncio
 import os
 import base64
+import json
 import re
-import cv2
 import time
-import shutil
-from TikTokApi import TikTokApi
+import uuid
 import uvicorn
 
 # Импортируем наши модули
+import cache
 import config
 import database
+import eviction
+import executors
+import jobs
+import locks
+import metrics
+import music
+import responses
+import scheduler
 import services
+import sessions
 
 # --- Создание папок ---
-for folder in [config.VIDEO_CACHE_DIR, config.AUDIO_DIR, config.TEMP_IMAGE_DIR, "templates/static", "templates/partials"]:
+for folder in [config.VIDEO_CACHE_DIR, config.AUDIO_DIR, config.TEMP_IMAGE_DIR, config.THUMB_DIR, config.LOCK_DIR, "templates/static", "templates/partials"]:
     if not os.path.exists(folder):
         os.makedirs(folder)
         
 app_state = {}
-
-# --- Функция для очистки временных папок с картинками ---
-async def cleanup_folder(path: str, delay_seconds: int):
-    await asyncio.sleep(delay_seconds)
-    if os.path.exists(path):
-        try:
-            shutil.rmtree(path)
-            config.logger.info(f"Временная папка удалена: {path}")
-        except Exception as e:
-            config.logger.error(f"Ошибка при удалении временной папки {path}: {e}")
+metadata_cache = cache.LRUCache(config.METADATA_CACHE_SIZE, ttl=config.METADATA_CACHE_TTL)
+short_url_cache = cache.LRUCache(config.SHORT_URL_CACHE_SIZE, ttl=config.SHORT_URL_CACHE_TTL)
 
 # --- Улучшенная функция для извлечения ID ---
 def extract_video_id_from_url(url: str) -> str | None:
@@ -45,24 +47,136 @@ def extract_video_id_from_url(url: str) -> str | None:
     if match: return match.group(0)
     return None
 
+# --- Раскрытие ссылок с кэшем коротких ссылок ---
+def normalize_short_url(url: str) -> str:
+    return url.split("?")[0].split("#")[0].rstrip("/").replace("http://", "https://", 1)
+
+async def resolve_url(original_url: str) -> tuple[str, str | None]:
+    """Возвращает (раскрытая ссылка, ID видео). Короткие ссылки сначала ищутся в памяти и в БД."""
+    # Полные ссылки содержат ID, их раскрывать не нужно
+    resolved_url = original_url.split("?")[0]
+    if video_id := extract_video_id_from_url(resolved_url):
+        return resolved_url, video_id
+
+    short_url = normalize_short_url(original_url)
+    if cached := short_url_cache.get(short_url):
+        cache.counters["short_url_memory_hits"] += 1
+        return cached
+    if cached := await database.get_resolved_url(short_url):
+        cache.counters["short_url_db_hits"] += 1
+        short_url_cache.set(short_url, cached)
+        return cached
+
+    cache.counters["short_url_misses"] += 1
+    with metrics.stage("resolve_short_url"):
+        resolved_url = await services.resolve_short_url(original_url, app_state["http"])
+    video_id = extract_video_id_from_url(resolved_url)
+    if video_id:
+        short_url_cache.set(short_url, (resolved_url, video_id))
+        await database.save_resolved_url(short_url, resolved_url, video_id)
+    return resolved_url, video_id
+
+# --- Быстрый путь: отдаем видео из кэша без обращения к TikTok ---
+def music_file_present(metadata: dict) -> bool:
+    music_file_id = metadata.get("music_file_id")
+    return not music_file_id or os.path.exists(os.path.join(config.AUDIO_DIR, f"{music_file_id}.mp3"))
+
+async def load_cached_video(video_id: str, count_stats: bool = True) -> tuple | None:
+    """Ищет видео сначала в памяти, затем в SQLite. Возвращает (путь к файлу, метаданные).
+    Промахи считает fetch_post: пост может найтись и среди альбомов."""
+    cached = metadata_cache.get(video_id)
+    if cached and os.path.exists(cached[0]) and music_file_present(cached[1]):
+        if count_stats: cache.counters["memory_hits"] += 1
+        eviction.touch(cached[0])
+        return cached
+    if cached:
+        # Файл видео или трека удален: запись из БД заново проверит оба файла и обновит music_file_id
+        metadata_cache.pop(video_id)
+
+    video_file_path, metadata = await database.get_cached_video(video_id)
+    if video_file_path:
+        if count_stats: cache.counters["db_hits"] += 1
+        eviction.touch(video_file_path)
+        metadata_cache.set(video_id, (video_file_path, metadata))
+        return video_file_path, metadata
+    return None
+
+async def load_cached_album(album_id: str, count_stats: bool = True) -> dict | None:
+    """Ищет скачанный фотоальбом в памяти и в SQLite. Возвращает готовый ответ."""
+    key = f"album:{album_id}"
+    cached = metadata_cache.get(key)
+    if cached and os.path.isdir(cached[0]):
+        if count_stats: cache.counters["album_hits"] += 1
+        eviction.touch(cached[0])
+        return cached[1]
+    if cached:
+        metadata_cache.pop(key)
+
+    if cached := await database.get_cached_album(album_id):
+        dir_path, metadata, images = cached
+        if count_stats: cache.counters["album_hits"] += 1
+        eviction.touch(dir_path)
+        content = build_album_content(album_id, metadata, images)
+        metadata_cache.set(key, (dir_path, content))
+        return content
+    return None
+
+async def load_cached_post(video_id: str) -> dict | None:
+    """Готовый ответ из кэша для видео или фотоальбома."""
+    if cached := await load_cached_video(video_id):
+        return build_video_content(video_id, cached[1])
+    return await load_cached_album(video_id)
+
+def build_video_content(video_id: str, metadata: dict) -> dict:
+    """Ответ для видео: только метаданные и ссылка на файл, сам файл отдает /video_file."""
+    return {"metadata": metadata, "videoId": video_id, "videoUrl": f"/video_file/{video_id}"}
+
+def build_album_content(album_id: str, metadata: dict, images: list) -> dict:
+    """Ответ для фотоальбома: image_paths — только скачанные фото, images — статус каждого фото."""
+    image_paths = [image["url"] for image in images if image["status"] == "ok"]
+    return {"metadata": metadata, "videoId": album_id, "image_paths": image_paths, "images": images}
+
+def read_video_base64_sync(video_id: str) -> str:
+    """Старый формат ответа: видео целиком в base64. Включается параметром include_base64."""
+    with open(os.path.join(config.VIDEO_CACHE_DIR, f"{video_id}.mp4"), "rb") as f:
+        return base64.b64encode(f.read()).decode('utf-8')
+
+# --- Разбор видео после скачивания: детали и миниатюры за одно открытие файла ---
+async def probe_video(video_id: str, video_file_path: str) -> dict:
+    thumb_dir = os.path.join(config.THUMB_DIR, video_id)
+    with metrics.stage("probe"):
+        video_details = await services.probe_video(video_file_path, thumb_dir)
+    if os.path.isdir(thumb_dir):
+        thumbs_size = sum(entry.stat().st_size for entry in os.scandir(thumb_dir) if entry.is_file())
+        await database.register_cache_file(thumb_dir, "thumbs", video_id, thumbs_size)
+    return video_details
+
 # --- Контекст жизни приложения (запуск и остановка) ---
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     database.init_db_sync()
-    config.logger.info("Запускаем TikTok API и создаем сессию...")
-    api = TikTokApi()
-    if config.MS_TOKEN:
-        await api.create_sessions(ms_tokens=[config.MS_TOKEN], num_sessions=1, sleep_after=3, headless=True, browser="chromium")
-    else:
-        config.logger.error("MS_TOKEN не найден! API TikTok не будет работать.")
-    app_state["api"] = api
-    app_state["shazam"] = services.Shazam()
-    app_state["lock"] = asyncio.Lock()
+    await database.open_pool()
+    executors.start()
+    app_state["http"] = services.create_http_client()
+    config.logger.info("Запускаем TikTok API и создаем сессии...")
+    app_state["sessions"] = sessions.SessionPool(config.MS_TOKENS, config.TIKTOK_SESSIONS_PER_TOKEN, app_state["http"])
+    await app_state["sessions"].start()
+    # shazamio импортируется в фоне, первый распознающий запрос дождется его
+    app_state["shazam"] = asyncio.create_task(executors.run_io(services.create_shazam))
+    app_state["scheduler"] = scheduler.JobScheduler(config.MAX_CONCURRENT_JOBS)
+    app_state["jobs"] = jobs.JobManager(fetch_post, app_state["http"], config.JOB_WORKERS)
+    await app_state["jobs"].start()
+    app_state["eviction"] = eviction.EvictionManager()
+    await app_state["eviction"].start()
     config.logger.info(">>> Python API готов к приему запросов! <<<")
     yield
-    config.logger.info("Закрываем сессию TikTok API...")
-    if "api" in app_state and app_state["api"]:
-        await app_state["api"].close_sessions()
+    await app_state["jobs"].stop()
+    await app_state["eviction"].stop()
+    config.logger.info("Закрываем сессии TikTok API...")
+    await app_state["sessions"].stop()
+    await app_state["http"].aclose()
+    await database.close_pool()
+    executors.shutdown()
 
 app = FastAPI(lifespan=lifespan)
 
@@ -71,101 +185,386 @@ app.mount("/static", StaticFiles(directory="templates/static"), name="static")
 app.mount("/temp_images", StaticFiles(directory=config.TEMP_IMAGE_DIR), name="temp_images")
 templates = Jinja2Templates(directory="templates")
 
+# --- ID запроса и время ответа для каждого HTTP-запроса ---
+TRACE_ID_RE = re.compile(r'^[A-Za-z0-9._-]{1,64}$')
+
+@app.middleware("http")
+async def trace_requests(request: Request, call_next):
+    incoming = request.headers.get(config.TRACE_ID_HEADER) if config.TRACE_ID_HEADER else None
+    trace_id = incoming if incoming and TRACE_ID_RE.match(incoming) else uuid.uuid4().hex[:16]
+    config.trace_id_var.set(trace_id)
+    started = time.monotonic()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+    finally:
+        route = request.scope.get("route")
+        metrics.http_request_seconds.observe(
+            time.monotonic() - started, method=request.method, route=getattr(route, "path", "other"), status=status
+        )
+    if config.TRACE_ID_HEADER:
+        response.headers[config.TRACE_ID_HEADER] = trace_id
+    return response
+
+class JobRequest(BaseModel):
+    url: str
+    callback_url: str | None = None
+
 @app.get("/video_data")
-async def get_video_data(original_url: str):
+async def get_video_data(original_url: str, include_base64: bool = False):
     config.logger.info(f"Получен запрос для URL: {original_url}")
-    async with app_state["lock"]:
-        api = app_state["api"]
-        resolved_url = await services.resolve_short_url(original_url)
-        video_id = extract_video_id_from_url(resolved_url)
+    content = await fetch_post(original_url)
+    if include_base64 and "videoUrl" in content:
+        try:
+            video_base64 = await executors.run_io(read_video_base64_sync, content["videoId"])
+        except FileNotFoundError:
+            # Файл могли вытеснить из кэша между ответом и чтением
+            raise HTTPException(status_code=404, detail="Видеофайл не найден.")
+        content = {**content, "videoBase64": video_base64}
+    return JSONResponse(content=content)
+
+@app.post("/jobs", status_code=202)
+async def create_job(job_request: JobRequest):
+    if job_request.callback_url:
+        try:
+            await services.check_callback_url(job_request.callback_url)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+    job_id = await app_state["jobs"].submit(job_request.url, job_request.callback_url)
+    return {"job_id": job_id, "status": "queued", "status_url": f"/jobs/{job_id}"}
+
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str):
+    job = await database.get_job(job_id)
+    if not job: raise HTTPException(status_code=404, detail="Задача не найдена.")
+    return job
+
+# --- Пакетная обработка: много ссылок или лента автора, хэштега, звука ---
+class BatchRequest(BaseModel):
+    urls: list[str] = []
+    user: str | None = None
+    hashtag: str | None = None
+    music_id: str | None = None
+    count: int = config.BATCH_FEED_COUNT
+    concurrency: int | None = None
+
+BATCH_FEEDS = {"user": "user", "hashtag": "hashtag", "music_id": "music"}
+
+def build_post_url(post_data: dict) -> str:
+    author = (post_data.get("author") or {}).get("uniqueId", "")
+    kind = "photo" if post_data.get("imagePost") else "video"
+    return f"https://www.tiktok.com/@{author}/{kind}/{post_data['id']}"
+
+async def expand_batch_urls(batch_request: BatchRequest) -> list[str]:
+    """Ссылки из запроса вместе с постами из лент. Одинаковые ссылки отбрасываются сразу."""
+    urls = [url.strip() for url in batch_request.urls if url.strip()]
+    count = min(max(batch_request.count, 1), config.BATCH_MAX_URLS)
+    for field, kind in BATCH_FEEDS.items():
+        value = (getattr(batch_request, field) or "").strip().lstrip("@#")
+        if not value: continue
+        try:
+            with metrics.stage("tiktok_feed"):
+                items = await app_state["sessions"].feed_videos(kind, value, count)
+        except sessions.SessionUnavailableError as e:
+            raise HTTPException(status_code=503, detail=str(e))
+        except Exception as e:
+            config.logger.warning(f"Не удалось получить ленту {kind} {value}: {e}")
+            raise HTTPException(status_code=502, detail=f"Не удалось получить ленту {value} от TikTok.")
+        config.logger.info(f"Лента {kind} {value}: постов {len(items)}.")
+        urls += [build_post_url(item) for item in items if item.get("id")]
+    urls = list(dict.fromkeys(urls))
+    if not urls:
+        raise HTTPException(status_code=400, detail="Нет ссылок для обработки.")
+    if len(urls) > config.BATCH_MAX_URLS:
+        raise HTTPException(status_code=400, detail=f"Слишком много ссылок: {len(urls)}, максимум {config.BATCH_MAX_URLS}.")
+    return urls
+
+async def process_batch_item(index: int, url: str, seen: set, semaphore: asyncio.Semaphore) -> dict:
+    """Обрабатывает одну ссылку пакета. Посты из кэша и повторы ID не ждут семафор пакета."""
+    item = {"index": index, "url": url}
+    try:
+        resolved_url, video_id = await resolve_url(url)
         if not video_id:
             raise HTTPException(status_code=400, detail="Не удалось извлечь ID из ссылки.")
+        item["videoId"] = video_id
+        if video_id in seen:
+            return {**item, "status": "duplicate"}
+        seen.add(video_id)
+        if cached := await load_cached_post(video_id):
+            return {**item, "status": "cached", "result": cached}
+        async with semaphore:
+            return {**item, "status": "done", "result": await fetch_post(resolved_url)}
+    except Exception as e:
+        error = getattr(e, "detail", None) or str(e) or type(e).__name__
+        config.logger.warning(f"Ссылка {url} из пакета не обработана: {error}")
+        return {**item, "status": "failed", "error": error}
+
+def format_batch_event(event: str, data: dict, sse: bool) -> str:
+    payload = json.dumps(data, ensure_ascii=False)
+    return f"event: {event}\ndata: {payload}\n\n" if sse else payload + "\n"
+
+async def stream_batch(urls: list, concurrency: int, sse: bool):
+    """Отдает результаты по мере готовности, последней строкой — итог по статусам."""
+    semaphore = asyncio.Semaphore(concurrency)
+    seen = set()
+    tasks = [asyncio.create_task(process_batch_item(index, url, seen, semaphore)) for index, url in enumerate(urls)]
+    counts = {}
+    try:
+        for next_item in asyncio.as_completed(tasks):
+            item = await next_item
+            counts[item["status"]] = counts.get(item["status"], 0) + 1
+            metrics.batch_items.inc(status=item["status"])
+            yield format_batch_event("item", item, sse)
+        yield format_batch_event("done", {"done": True, "total": len(urls), "counts": counts}, sse)
+    finally:
+        # Если клиент отключился, еще не начатые посты не обрабатываем. Начатые доделает планировщик
+        for task in tasks:
+            task.cancel()
+
+@app.post("/batch")
+async def create_batch(request: Request, batch_request: BatchRequest, format: str | None = None):
+    """Прогрев кэша пачкой ссылок. Ответ — NDJSON или server-sent events (format=sse или Accept: text/event-stream)."""
+    if format not in (None, "ndjson", "sse"):
+        raise HTTPException(status_code=400, detail="Формат должен быть ndjson или sse.")
+    sse = format == "sse" or (format is None and "text/event-stream" in request.headers.get("accept", ""))
+    urls = await expand_batch_urls(batch_request)
+    concurrency = min(max(batch_request.concurrency or config.BATCH_CONCURRENCY, 1), config.BATCH_MAX_CONCURRENCY)
+    config.logger.info(f"Пакет из {len(urls)} ссылок, одновременно: {concurrency}.")
+    return StreamingResponse(
+        stream_batch(urls, concurrency, sse),
+        media_type="text/event-stream" if sse else "application/x-ndjson",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+async def fetch_post(original_url: str, on_progress=None) -> dict:
+    """Отдает пост из кэша или ставит его обработку в планировщик."""
+    resolved_url, video_id = await resolve_url(original_url)
+    if not video_id:
+        raise HTTPException(status_code=400, detail="Не удалось извлечь ID из ссылки.")
+
+    if cached := await load_cached_post(video_id):
+        config.logger.info(f"Отдаю пост {video_id} из кэша.")
+        return cached
+    cache.counters["misses"] += 1
+    # Одинаковые ID обрабатываются одной задачей, разные — параллельно.
+    # Промежуточные результаты получает только тот, кто запустил задачу.
+    return await app_state["scheduler"].run(video_id, lambda: process_post(video_id, resolved_url, on_progress))
+
+async def download_album_image(album_id: str, album_dir: str, index: int, image_url: str) -> dict:
+    """Скачивает одно фото альбома и возвращает его статус. Уже скачанные файлы не перекачиваются."""
+    filename = f"image_{index}.jpeg"
+    full_path = os.path.join(album_dir, filename)
+    status = {"index": index, "url": f"/temp_images/{album_id}/{filename}"}
+    try:
+        if not os.path.exists(full_path):
+            with metrics.stage("image_download"):
+                await services.download_image(image_url, full_path, app_state["http"], max_bytes=config.IMAGE_MAX_BYTES)
+        with metrics.stage("image_prepare"):
+            image_details = await services.prepare_image(full_path)
+        return {**status, "status": "ok", **image_details}
+    except Exception as e:
+        if os.path.exists(full_path):
+            os.remove(full_path)
+        return {**status, "status": "failed", "error": str(e) or type(e).__name__}
+
+async def download_album(album_id: str, post_data: dict, image_urls: list) -> dict:
+    album_dir = os.path.join(config.TEMP_IMAGE_DIR, album_id)
+    os.makedirs(album_dir, exist_ok=True)
+    # Параллельность ограничена семафором хоста в services.download_image
+    images = await asyncio.gather(*(
+        download_album_image(album_id, album_dir, i, image_url) for i, image_url in enumerate(image_urls, start=1)
+    ))
+    album_size = sum(entry.stat().st_size for entry in os.scandir(album_dir) if entry.is_file())
+    failed = [image for image in images if image["status"] != "ok"]
+    if failed:
+        config.logger.warning(f"В альбоме {album_id} не скачано фото: {len(failed)} из {len(images)}.")
+        # Неполный альбом в кэш не попадает: следующий запрос докачает недостающие фото.
+        # Папку удалит механизм вытеснения через TEMP_IMAGE_TTL
+        await database.register_cache_file(album_dir, "images", album_id, album_size)
+        if len(failed) == len(images):
+            raise HTTPException(status_code=502, detail="Не удалось скачать ни одного изображения.")
+    else:
+        await database.save_album(album_id, post_data, images, album_dir, album_size)
+    content = build_album_content(album_id, post_data, images)
+    if not failed:
+        metadata_cache.set(f"album:{album_id}", (album_dir, content))
+    return content
+
+async def process_post(video_id: str, resolved_url: str, on_progress=None) -> dict:
+    """Обрабатывает пост под файловой блокировкой: если тот же пост уже обрабатывает другой процесс uvicorn,
+    ждем его и берем готовый результат из кэша."""
+    async with locks.file_lock(locks.striped("post", video_id)):
+        return await process_post_locked(video_id, resolved_url, on_progress)
+
+async def process_post_locked(video_id: str, resolved_url: str, on_progress=None) -> dict:
+    """Полный цикл обработки поста: метаданные, медиафайлы, Shazam и музыка.
+    on_progress(stage, partial_result) вызывается, когда готова очередная часть результата."""
+    async def report(stage: str, partial_result: dict):
+        if on_progress: await on_progress(stage, partial_result)
+
+    session_pool = app_state["sessions"]
+    # Пока задача ждала в очереди или на блокировке, видео мог скачать другой запрос или процесс
+    if cached := await load_cached_video(video_id, count_stats=False):
+        return build_video_content(video_id, cached[1])
+    if album := await load_cached_album(video_id, count_stats=False):
+        return album
+
+    # --- ГИБРИДНАЯ ЛОГИКА ---
+    if 'photo' in resolved_url:
+        # --- Логика для ФОТОАЛЬБОМОВ ---
+        config.logger.info(f"Обнаружен фотоальбом (ID: {video_id}). Использую прямой метод API.")
+        try:
+            with metrics.stage("tiktok_info"):
+                api_response, _ = await session_pool.item_detail(video_id)
+            post_data = api_response.get("itemInfo", {}).get("itemStruct")
+            if not post_data: raise ValueError("Ключ 'itemStruct' не найден в ответе API TikTok.")
+        except sessions.SessionUnavailableError as e:
+            raise HTTPException(status_code=503, detail=str(e))
+        except Exception as e:
+            raise HTTPException(status_code=500, detail="Не удалось получить данные от TikTok.")
+
+        image_urls = [img['imageURL']['urlList'][0] for img in post_data.get('imagePost', {}).get('images', [])]
+        if not image_urls: raise HTTPException(status_code=404, detail="Не найдены URL изображений.")
+        await report("images", {"metadata": post_data})
+        return await download_album(video_id, post_data, image_urls)
+    
+    else:
+        # --- Логика для ВИДЕО ---
+        config.logger.info(f"Обнаружено видео (ID: {video_id}). Получаю информацию...")
+        try:
+            with metrics.stage("tiktok_info"):
+                post_data, session = await session_pool.video_info(resolved_url, video_id)
+        except sessions.SessionUnavailableError as e:
+            raise HTTPException(status_code=503, detail=str(e))
+        except Exception as e:
+            raise HTTPException(status_code=500, detail="Не удалось получить информацию о видео.")
+
+        download_url = post_data.get("video", {}).get("playAddr")
+        if not download_url:
+            raise HTTPException(status_code=404, detail="URL для скачивания видео без водяного знака не найден.")
+        await report("video", {"metadata": post_data})
         
-        # --- ГИБРИДНАЯ ЛОГИКА ---
-        if 'photo' in resolved_url:
-            # --- Логика для ФОТОАЛЬБОМОВ ---
-            config.logger.info(f"Обнаружен фотоальбом (ID: {video_id}). Использую прямой метод API.")
-            try:
-                api_url = "https://www.tiktok.com/api/item/detail/"
-                params = {"itemId": video_id}
-                api_response = await api.make_request(url=api_url, params=params)
-                post_data = api_response.get("itemInfo", {}).get("itemStruct")
-                if not post_data: raise ValueError("Ключ 'itemStruct' не найден в ответе API TikTok.")
-            except Exception as e:
-                raise HTTPException(status_code=500, detail="Не удалось получить данные от TikTok.")
-
-            image_urls = [img['imageURL']['urlList'][0] for img in post_data.get('imagePost', {}).get('images', [])]
-            if not image_urls: raise HTTPException(status_code=404, detail="Не найдены URL изображений.")
-            
-            temp_image_dir_abs = os.path.join(config.TEMP_IMAGE_DIR, video_id)
-            os.makedirs(temp_image_dir_abs, exist_ok=True)
-            download_tasks, relative_image_urls = [], []
-            for i, img_url in enumerate(image_urls):
-                filename, full_path = f"image_{i+1}.jpeg", os.path.join(temp_image_dir_abs, f"image_{i+1}.jpeg")
-                download_tasks.append(services.download_image_simple(img_url, full_path))
-                relative_image_urls.append(f"/temp_images/{video_id}/{filename}")
-            await asyncio.gather(*download_tasks)
-            asyncio.create_task(cleanup_folder(temp_image_dir_abs, delay_seconds=600))
-            return JSONResponse(content={"metadata": post_data, "image_paths": relative_image_urls})
+        config.logger.info("Скачиваю видеофайл без водяного знака...")
+        video_file_path = os.path.abspath(os.path.join(config.VIDEO_CACHE_DIR, f"{video_id}.mp4"))
+        try:
+            with metrics.stage("video_download"):
+                # Скачиваем с cookies той же сессии, что выдала ссылку на видео
+                headers, cookies = await session_pool.download_context(session)
+                await services.download_video_with_session(download_url, video_file_path, app_state["http"], headers, cookies, max_bytes=config.VIDEO_MAX_BYTES or None)
+        except services.DownloadTooLargeError as e:
+            raise HTTPException(status_code=413, detail=str(e))
         
-        else:
-            # --- Логика для ВИДЕО ---
-            config.logger.info(f"Обнаружено видео (ID: {video_id}). Получаю информацию...")
-            try:
-                post_obj = api.video(url=resolved_url)
-                post_data = await post_obj.info()
-            except Exception as e:
-                raise HTTPException(status_code=500, detail="Не удалось получить информацию о видео.")
-
-            download_url = post_data.get("video", {}).get("playAddr")
-            if not download_url:
-                raise HTTPException(status_code=404, detail="URL для скачивания видео без водяного знака не найден.")
-            
-            config.logger.info("Скачиваю видеофайл без водяного знака...")
-            video_bytes = await services.download_video_with_session(download_url, api)
-
-            video_file_path = os.path.abspath(os.path.join(config.VIDEO_CACHE_DIR, f"{video_id}.mp4"))
-            with open(video_file_path, "wb") as f: f.write(video_bytes)
-            
-            video_details = services.get_video_details(video_file_path)
-            shazam_result, audio_file_path = await services.recognize_and_download_shazam(video_bytes, app_state["shazam"])
-            
-            post_data.update({
-                "shazam": shazam_result,
-                "videoDetails": video_details,
-                "music_file_id": os.path.basename(audio_file_path).replace('.mp3', '') if audio_file_path else None
-            })
-            
-            await database.save_video_to_cache(video_id, post_data, video_file_path, audio_file_path)
-            
-            video_base64 = base64.b64encode(video_bytes).decode('utf-8')
-            return JSONResponse(content={"metadata": post_data, "videoBase64": video_base64})
+        video_details = await probe_video(video_id, video_file_path)
+        post_data["videoDetails"] = video_details
+        await report("music", build_video_content(video_id, post_data))
+        music_id = (post_data.get("music") or {}).get("id")
+        shazam_result, audio_file_path = await music.recognize_music(video_file_path, music_id, await app_state["shazam"])
+        
+        post_data.update({
+            "shazam": shazam_result,
+            "music_file_id": os.path.basename(audio_file_path).replace('.mp3', '') if audio_file_path else None
+        })
+        
+        await database.save_video_to_cache(video_id, post_data, video_file_path, audio_file_path)
+        metadata_cache.set(video_id, (video_file_path, post_data))
+        return build_video_content(video_id, post_data)
 
 # --- Остальные эндпоинты ---
+@app.get("/stats")
+async def get_stats():
+    return {
+        "cache": {**cache.counters, "memory": metadata_cache.stats(), "short_urls": short_url_cache.stats()},
+        "scheduler": app_state["scheduler"].stats(),
+        "executors": executors.get_stats(),
+        "jobs": app_state["jobs"].stats(),
+        "sessions": app_state["sessions"].stats(),
+        "disk": await app_state["eviction"].stats(),
+    }
+
+# --- Метрики для Prometheus: значения, которые уже считают другие модули ---
+def cache_hit_ratios() -> dict:
+    counters = cache.counters
+    def ratio(hits: int, misses: int) -> float:
+        return round(hits / (hits + misses), 4) if hits + misses else 0.0
+    return {
+        "posts": ratio(counters["memory_hits"] + counters["db_hits"] + counters["album_hits"], counters["misses"]),
+        "short_urls": ratio(counters["short_url_memory_hits"] + counters["short_url_db_hits"], counters["short_url_misses"]),
+        "music": ratio(counters["music_hits"], counters["music_misses"]),
+        "tracks": ratio(counters["track_hits"], counters["track_downloads"]),
+    }
+
+def in_flight_tasks() -> dict:
+    values = {}
+    for queue_scheduler in (app_state["scheduler"], music.track_downloads):
+        values[(queue_scheduler.name, "running")] = queue_scheduler.running
+        values[(queue_scheduler.name, "waiting")] = queue_scheduler.waiting
+    values[("jobs", "running")] = app_state["jobs"].stats()["running"]
+    for kind, pool_stats in executors.stats.items():
+        values[(f"executor_{kind}", "running")] = pool_stats.active
+    return values
+
+metrics.Gauge("tiktok_cache_events_total", "Попадания и промахи кэшей.", labels=("event",), collect=lambda: cache.counters, kind="counter")
+metrics.Gauge("tiktok_cache_hit_ratio", "Доля попаданий в кэш.", labels=("cache",), collect=cache_hit_ratios)
+metrics.Gauge(
+    "tiktok_sessions", "Сессии TikTok по состоянию.", labels=("state",),
+    collect=lambda: {"healthy": app_state["sessions"].stats()["healthy"], "total": app_state["sessions"].stats()["total"]},
+)
+metrics.Gauge("tiktok_in_flight", "Задачи в работе и в очереди.", labels=("queue", "state"), collect=in_flight_tasks)
+
+# --- Проверки для балансировщика и PM2 ---
+@app.get("/health")
+async def health():
+    """Процесс жив и обслуживает запросы."""
+    return {"status": "ok", "pid": os.getpid()}
+
+@app.get("/ready")
+async def ready():
+    """Готов ли процесс обрабатывать новые ссылки. Браузер TikTok и Shazam прогреваются в фоне после старта."""
+    shazam_task = app_state.get("shazam")
+    checks = {
+        "database": database.is_pool_open(),
+        "tiktok_sessions": "sessions" in app_state and app_state["sessions"].is_ready,
+        "shazam": bool(shazam_task and shazam_task.done() and not shazam_task.cancelled() and not shazam_task.exception()),
+    }
+    is_ready = all(checks.values())
+    return JSONResponse(status_code=200 if is_ready else 503, content={"ready": is_ready, "pid": os.getpid(), "checks": checks})
+
+@app.get("/metrics")
+async def get_metrics():
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
 @app.get("/video_file/{video_id}")
-async def get_video_file(video_id: str):
+async def get_video_file(request: Request, video_id: str):
     file_path = os.path.join(config.VIDEO_CACHE_DIR, f"{video_id}.mp4")
     if not os.path.exists(file_path): raise HTTPException(status_code=404, detail="Видеофайл не найден.")
-    return FileResponse(path=file_path, media_type='video/mp4')
+    eviction.touch(file_path)
+    return responses.file_response(request, file_path, media_type='video/mp4')
 
 @app.get("/audio/{file_id}")
-async def get_audio_file(file_id: str):
+async def get_audio_file(request: Request, file_id: str):
     file_path = os.path.join(config.AUDIO_DIR, f"{file_id}.mp3")
     if not os.path.exists(file_path): raise HTTPException(status_code=404, detail="Аудиофайл не найден.")
-    return FileResponse(path=file_path, media_type='audio/mpeg', filename=f"track.mp3")
+    eviction.touch(file_path)
+    return responses.file_response(request, file_path, media_type='audio/mpeg', filename=f"track.mp3")
 
 @app.get("/video_thumb/{video_id}")
-async def get_video_thumbnail(video_id: str):
-    video_path = os.path.join(config.VIDEO_CACHE_DIR, f"{video_id}.mp4")
-    if not os.path.exists(video_path):
-        raise HTTPException(status_code=404, detail="Видео не найдено.")
-    cap = cv2.VideoCapture(video_path)
-    success, image = cap.read()
-    cap.release()
-    if not success: raise HTTPException(status_code=500, detail="Не удалось извлечь кадр из видео.")
-    success, buffer = cv2.imencode('.jpg', image)
-    if not success: raise HTTPException(status_code=500, detail="Не удалось закодировать кадр в JPEG.")
-    return Response(content=buffer.tobytes(), media_type='image/jpeg')
+async def get_video_thumbnail(request: Request, video_id: str, size: int = config.THUMBNAIL_DEFAULT_SIZE, format: str = "jpg"):
+    if size not in config.THUMBNAIL_SIZES or format not in ("jpg", "webp") or (format == "webp" and not config.THUMBNAIL_WEBP):
+        raise HTTPException(status_code=400, detail="Такой размер или формат миниатюры не поддерживается.")
+    thumb_dir = os.path.join(config.THUMB_DIR, video_id)
+    thumb_path = os.path.join(thumb_dir, f"{size}.{format}")
+    if not os.path.exists(thumb_path):
+        # Видео, скачанные до появления миниатюр, разбираем один раз при первом обращении
+        video_path = os.path.join(config.VIDEO_CACHE_DIR, f"{video_id}.mp4")
+        if not os.path.exists(video_path):
+            raise HTTPException(status_code=404, detail="Видео не найдено.")
+        await probe_video(video_id, video_path)
+        if not os.path.exists(thumb_path): raise HTTPException(status_code=500, detail="Не удалось извлечь кадр из видео.")
+    eviction.touch(thumb_dir)
+    media_type = 'image/webp' if format == "webp" else 'image/jpeg'
+    return responses.file_response(request, thumb_path, media_type=media_type,
+                                   headers={"Cache-Control": f"public, max-age={config.THUMBNAIL_MAX_AGE}, immutable"})
 
 
 @app.get("/download/{video_id}/{music_file_id}", response_class=HTMLResponse)
@@ -174,9 +573,11 @@ async def download_page_with_video(request: Request, video_id: str, music_file_i
     music_path = os.path.join(config.AUDIO_DIR, f"{music_file_id}.mp3")
     if not os.path.exists(video_path) or not os.path.exists(music_path):
         return HTMLResponse(content="<h1>Ошибка 404: Файл не найден или устарел.</h1>", status_code=404)
+    eviction.touch(video_path)
+    eviction.touch(music_path)
     
-    _ , metadata = await database.get_cached_video(video_id)
-    if not metadata:
+    summary = await database.get_video_summary(video_id)
+    if not summary:
         return HTMLResponse(content="<h1>Ошибка: Информация о видео не найдена.</h1>", status_code=404)
 
     try:
@@ -187,16 +588,17 @@ async def download_page_with_video(request: Request, video_id: str, music_file_i
     
     context = {
         "request": request, "video_id": video_id, "music_file_id": music_file_id,
-        "author_name": metadata.get("author", {}).get("uniqueId", "Автор"),
-        "video_desc": metadata.get("desc", ""),
-        "author_avatar_url": metadata.get("author", {}).get("avatarThumb", ""),
-        "track_title": metadata.get("shazam", {}).get("title", "Трек из видео"),
-        "track_artist": metadata.get("shazam", {}).get("artist", "Исполнитель"),
-        "cover_url": f"/video_thumb/{video_id}",
+        "author_name": summary["author_unique_id"] or "Автор",
+        "video_desc": summary["description"] or "",
+        "author_avatar_url": summary["author_avatar"] or "",
+        "track_title": summary["shazam_title"] or "Трек из видео",
+        "track_artist": summary["shazam_artist"] or "Исполнитель",
+        "cover_url": f"/video_thumb/{video_id}?size={config.THUMBNAIL_SIZES[0]}",
         "css_version": css_version, "js_version": js_version
     }
     return templates.TemplateResponse("download_page.html", context)
 
 if __name__ == "__main__":
     os.chdir(os.path.dirname(__file__))
-    uvicorn.run("api:app", host="0.0.0.0", port=18361, reload=True)
\ No newline at end of file
+    # Каждый процесс — отдельное приложение со своим браузером; общие очередь, кэш и блокировки — в cache.db и LOCK_DIR
+    uvicorn.run("api:app", host="0.0.0.0", port=18361, reload=config.API_WORKERS == 1, workers=config.API_WORKERS)
\ No newline at end of file
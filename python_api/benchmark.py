@@ -0,0 +1,438 @@
+# python_api/benchmark.py
+"""Нагрузочный тест API без обращения к TikTok, Shazam и YouTube.
+
+TikTok и его CDN заменяет локальный сервер, Shazam и YoutubeDL — заглушки с настраиваемой задержкой.
+Все файлы и база создаются во временной папке, рабочий кэш не затрагивается.
+
+    python benchmark.py --requests 200 --concurrency 20
+    python benchmark.py --scenario video_repeat --scenario mixed --json results.json
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import shutil
+import socket
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import types
+
+# Заглушки работают только в этом процессе, поэтому тяжелые задачи выполняются в пуле потоков.
+# Переменные окружения нужно выставить до импорта config.
+os.environ.setdefault("MS_TOKEN", "benchmark")
+os.environ["CPU_POOL_WORKERS"] = "0"
+os.environ["MUSIC_POOL_WORKERS"] = "0"
+os.environ.setdefault("EVICTION_INTERVAL", "3600")
+
+import cv2
+import httpx
+import numpy as np
+import uvicorn
+from fastapi import FastAPI, Response
+from fastapi.responses import FileResponse, HTMLResponse, RedirectResponse
+
+import config
+
+BENCH_DIR = tempfile.mkdtemp(prefix="tiktok_bench_")
+config.DB_FILE = os.path.join(BENCH_DIR, "cache.db")
+config.VIDEO_CACHE_DIR = os.path.join(BENCH_DIR, "video_cache")
+config.AUDIO_DIR = os.path.join(BENCH_DIR, "audio_files")
+config.TEMP_IMAGE_DIR = os.path.join(BENCH_DIR, "temp_images")
+config.THUMB_DIR = os.path.join(BENCH_DIR, "thumbnails")
+config.LOCK_DIR = os.path.join(BENCH_DIR, "locks")
+# api.py подключает templates/static относительно текущей папки
+os.chdir(config.BASE_DIR)
+
+import api
+import cache
+import services
+import sessions
+
+VIDEO_ID_PREFIX = "74"
+PHOTO_ID_PREFIX = "75"
+IMAGES_PER_ALBUM = 4
+SCENARIOS = ["video_cold", "video_repeat", "photo", "short_links", "mixed"]
+
+def make_post_id(prefix: str, number: int) -> str:
+    return f"{prefix}{number:017d}"
+
+# В короткой ссылке ID закодирован в base36, иначе api.py найдет его в самой ссылке и не станет ее раскрывать
+def encode_short_code(post_id: str) -> str:
+    number, code = int(post_id), ""
+    while number:
+        number, digit = divmod(number, 36)
+        code = "0123456789abcdefghijklmnopqrstuvwxyz"[digit] + code
+    return code
+
+# --- Тестовые медиафайлы ---
+def create_sample_media(folder: str) -> tuple[str, str]:
+    video_path = os.path.join(folder, "sample.mp4")
+    writer = cv2.VideoWriter(video_path, cv2.VideoWriter_fourcc(*"mp4v"), 30, (540, 960))
+    rng = np.random.default_rng(0)
+    for _ in range(60):
+        writer.write(rng.integers(0, 255, (960, 540, 3), dtype=np.uint8))
+    writer.release()
+    image_path = os.path.join(folder, "sample.jpeg")
+    cv2.imwrite(image_path, rng.integers(0, 255, (1440, 1080, 3), dtype=np.uint8))
+    return video_path, image_path
+
+# --- Локальный сервер вместо TikTok и его CDN ---
+def create_fake_tiktok(video_path: str, image_path: str, latency: float) -> FastAPI:
+    fake = FastAPI()
+
+    def item_struct(post_id: str) -> dict:
+        item = {
+            "id": post_id,
+            "desc": f"Тестовый пост {post_id} #benchmark",
+            "author": {"uniqueId": "bench_author", "avatarThumb": "https://p16-sign.tiktokcdn.com/avatar.jpeg"},
+            "music": {"id": f"snd{int(post_id) % 50}", "title": "original sound", "authorName": "bench_author"},
+            "stats": {"diggCount": 1000, "commentCount": 10, "collectCount": 5, "shareCount": 1},
+        }
+        if post_id.startswith(PHOTO_ID_PREFIX):
+            item["imagePost"] = {"images": [
+                {"imageURL": {"urlList": [f"https://p16-sign.tiktokcdn.com/image/{post_id}/{n}.jpeg"]}} for n in range(IMAGES_PER_ALBUM)
+            ]}
+        else:
+            item["video"] = {"playAddr": f"https://v16-webapp.tiktok.com/video/{post_id}.mp4"}
+        return item
+
+    @fake.get("/api/item/detail/")
+    async def item_detail(itemId: str):
+        await asyncio.sleep(latency)
+        return {"itemInfo": {"itemStruct": item_struct(itemId)}}
+
+    @fake.api_route("/t/{code}", methods=["GET", "HEAD"])
+    async def short_link(code: str):
+        await asyncio.sleep(latency)
+        post_id = str(int(code, 36))
+        kind = "photo" if post_id.startswith(PHOTO_ID_PREFIX) else "video"
+        return RedirectResponse(f"https://www.tiktok.com/@bench_author/{kind}/{post_id}", status_code=301)
+
+    @fake.api_route("/@bench_author/{kind}/{post_id}", methods=["GET", "HEAD"])
+    async def post_page(kind: str, post_id: str):
+        # Страница поста с теми же данными, что разбирает sessions.extract_video_data
+        data = {"__DEFAULT_SCOPE__": {"webapp.video-detail": {"statusCode": 0, "itemInfo": {"itemStruct": item_struct(post_id)}}}}
+        script = f'<script id="__UNIVERSAL_DATA_FOR_REHYDRATION__" type="application/json">{json.dumps(data)}</script>'
+        return HTMLResponse(f"<html><body>{script}</body></html>")
+
+    @fake.get("/video/{name}")
+    async def video_file(name: str):
+        await asyncio.sleep(latency)
+        return FileResponse(video_path, media_type="video/mp4")
+
+    @fake.get("/image/{post_id}/{name}")
+    async def image_file(post_id: str, name: str):
+        await asyncio.sleep(latency)
+        return FileResponse(image_path, media_type="image/jpeg")
+
+    return fake
+
+class FakeServer:
+    """uvicorn в отдельном потоке на свободном порту."""
+
+    def __init__(self, app: FastAPI):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.bind(("127.0.0.1", 0))
+        self.port = self.sock.getsockname()[1]
+        self.server = uvicorn.Server(uvicorn.Config(app, log_level="warning", lifespan="off"))
+        self.thread = threading.Thread(target=lambda: asyncio.run(self.server.serve(sockets=[self.sock])), daemon=True)
+
+    def start(self):
+        self.thread.start()
+        while not self.server.started:
+            time.sleep(0.01)
+
+    def stop(self):
+        self.server.should_exit = True
+        self.thread.join(timeout=5)
+
+class LocalTransport(httpx.AsyncBaseTransport):
+    """Отправляет запросы к любым хостам на локальный сервер-заглушку."""
+
+    def __init__(self, port: int):
+        self.port = port
+        self._transport = httpx.AsyncHTTPTransport(limits=httpx.Limits(
+            max_connections=config.HTTP_MAX_CONNECTIONS, max_keepalive_connections=config.HTTP_MAX_KEEPALIVE
+        ))
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        request.url = request.url.copy_with(scheme="http", host="127.0.0.1", port=self.port)
+        return await self._transport.handle_async_request(request)
+
+    async def aclose(self):
+        await self._transport.aclose()
+
+def create_local_client(port: int) -> httpx.AsyncClient:
+    return httpx.AsyncClient(
+        transport=LocalTransport(port),
+        follow_redirects=True,
+        timeout=httpx.Timeout(config.HTTP_TIMEOUT, connect=config.HTTP_CONNECT_TIMEOUT),
+    )
+
+# --- Заглушки TikTokApi, Shazam и YoutubeDL ---
+class FakePage:
+    async def evaluate(self, script: str):
+        return "complete"
+
+    async def close(self):
+        pass
+
+class FakeSession:
+    def __init__(self, ms_token: str):
+        self.ms_token = ms_token
+        self.headers = {"User-Agent": "benchmark"}
+        self.page = FakePage()
+        self.context = FakePage()
+
+class FakeTikTokApi:
+    """Повторяет ту часть TikTokApi, которой пользуется sessions.SessionPool."""
+    port = None
+
+    def __init__(self):
+        self.sessions = []
+        self._client = create_local_client(self.port)
+
+    async def create_sessions(self, num_sessions: int = 0, ms_tokens: list | None = None, **kwargs):
+        for _ in range(num_sessions):
+            await self._TikTokApi__create_session(ms_token=random.choice(ms_tokens or [None]))
+
+    async def _TikTokApi__create_session(self, ms_token: str | None = None, **kwargs):
+        self.sessions.append(FakeSession(ms_token))
+
+    async def close_sessions(self):
+        self.sessions.clear()
+        await self._client.aclose()
+
+    async def make_request(self, url: str, params: dict, **kwargs) -> dict:
+        response = await self._client.get(url, params=params)
+        response.raise_for_status()
+        return response.json()
+
+    async def get_session_cookies(self, session) -> dict:
+        return {"msToken": session.ms_token}
+
+    async def set_session_cookies(self, session, cookies: list):
+        pass
+
+class FakeShazam:
+    latency = 0.0
+    tracks = 20
+
+    async def recognize(self, audio) -> dict:
+        await asyncio.sleep(self.latency)
+        number = hash(audio if isinstance(audio, (str, bytes)) else str(audio)) % self.tracks
+        return {"track": {"title": f"Track {number}", "subtitle": "Bench Artist", "key": f"bench{number}"}}
+
+class FakeYoutubeDL:
+    latency = 0.0
+
+    def __init__(self, params: dict):
+        self.params = params
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def download(self, queries: list) -> int:
+        time.sleep(self.latency)
+        with open(f"{self.params['outtmpl']}.mp3", "wb") as f:
+            f.write(os.urandom(256 * 1024))
+        return 0
+
+# --- Замеры процесса ---
+def read_rss_bytes() -> int:
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    return 0
+
+def count_open_fds() -> int:
+    try:
+        return len(os.listdir("/proc/self/fd"))
+    except OSError:
+        return 0
+
+class ResourceSampler:
+    """Пиковые RSS и число открытых дескрипторов за время сценария."""
+
+    def __init__(self, interval: float = 0.05):
+        self.interval = interval
+        self.peak_rss = 0
+        self.peak_fds = 0
+        self._task = None
+
+    async def _run(self):
+        while True:
+            self.peak_rss = max(self.peak_rss, read_rss_bytes())
+            self.peak_fds = max(self.peak_fds, count_open_fds())
+            await asyncio.sleep(self.interval)
+
+    def __enter__(self):
+        self._task = asyncio.create_task(self._run())
+        return self
+
+    def __exit__(self, *exc):
+        self._task.cancel()
+        self.peak_rss = max(self.peak_rss, read_rss_bytes())
+        self.peak_fds = max(self.peak_fds, count_open_fds())
+
+# --- Сценарии нагрузки ---
+class UrlFactory:
+    def __init__(self, seed: int):
+        self.rng = random.Random(seed)
+        self.next_id = 0
+        self.seen_videos = []
+
+    def _new_id(self, prefix: str) -> str:
+        self.next_id += 1
+        return make_post_id(prefix, self.next_id)
+
+    def cold_video(self) -> str:
+        post_id = self._new_id(VIDEO_ID_PREFIX)
+        self.seen_videos.append(post_id)
+        return f"https://www.tiktok.com/@bench_author/video/{post_id}"
+
+    def repeat_video(self) -> str:
+        if not self.seen_videos:
+            return self.cold_video()
+        return f"https://www.tiktok.com/@bench_author/video/{self.rng.choice(self.seen_videos)}"
+
+    def photo(self) -> str:
+        return f"https://www.tiktok.com/@bench_author/photo/{self._new_id(PHOTO_ID_PREFIX)}"
+
+    def short_link(self) -> str:
+        post_id = self._new_id(VIDEO_ID_PREFIX)
+        self.seen_videos.append(post_id)
+        return f"https://vm.tiktok.com/t/{encode_short_code(post_id)}"
+
+    def for_scenario(self, scenario: str) -> str:
+        if scenario == "mixed":
+            return self.rng.choices(
+                [self.repeat_video, self.cold_video, self.photo, self.short_link], weights=[50, 20, 15, 15]
+            )[0]()
+        return {
+            "video_cold": self.cold_video,
+            "video_repeat": self.repeat_video,
+            "photo": self.photo,
+            "short_links": self.short_link,
+        }[scenario]()
+
+def percentile(values: list, share: float) -> float:
+    if not values: return 0.0
+    ordered = sorted(values)
+    return ordered[min(int(round(share * (len(ordered) - 1))), len(ordered) - 1)]
+
+def cache_hits() -> int:
+    counters = cache.counters
+    return counters["memory_hits"] + counters["db_hits"] + counters["album_hits"]
+
+async def run_scenario(client: httpx.AsyncClient, urls: UrlFactory, scenario: str, total: int, concurrency: int) -> dict:
+    request_urls = [urls.for_scenario(scenario) for _ in range(total)]
+    latencies, errors = [], 0
+    semaphore = asyncio.Semaphore(concurrency)
+    hits_before = cache_hits()
+
+    async def one(url: str):
+        nonlocal errors
+        async with semaphore:
+            started = time.perf_counter()
+            try:
+                response = await client.get("/video_data", params={"original_url": url})
+                if response.status_code != 200:
+                    errors += 1
+            except Exception:
+                errors += 1
+            latencies.append(time.perf_counter() - started)
+
+    with ResourceSampler() as sampler:
+        started = time.perf_counter()
+        await asyncio.gather(*(one(url) for url in request_urls))
+        elapsed = time.perf_counter() - started
+
+    return {
+        "scenario": scenario,
+        "requests": total,
+        "concurrency": concurrency,
+        "errors": errors,
+        "cache_hits": cache_hits() - hits_before,
+        "rps": round(total / elapsed, 2) if elapsed else 0.0,
+        "p50_ms": round(percentile(latencies, 0.50) * 1000, 1),
+        "p95_ms": round(percentile(latencies, 0.95) * 1000, 1),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 1),
+        "mean_ms": round(statistics.fmean(latencies) * 1000, 1) if latencies else 0.0,
+        "peak_rss_mb": round(sampler.peak_rss / 1024 ** 2, 1),
+        "peak_fds": sampler.peak_fds,
+    }
+
+def print_report(results: list):
+    columns = ["scenario", "requests", "concurrency", "errors", "cache_hits", "rps", "p50_ms", "p95_ms", "p99_ms", "peak_rss_mb", "peak_fds"]
+    widths = {column: max(len(column), *(len(str(row[column])) for row in results)) for column in columns}
+    print("  ".join(column.ljust(widths[column]) for column in columns))
+    for row in results:
+        print("  ".join(str(row[column]).ljust(widths[column]) for column in columns))
+
+async def run_benchmark(args) -> list:
+    video_path, image_path = create_sample_media(BENCH_DIR)
+    fake_server = FakeServer(create_fake_tiktok(video_path, image_path, args.latency))
+    fake_server.start()
+
+    FakeTikTokApi.port = fake_server.port
+    FakeShazam.latency = args.shazam_latency
+    FakeYoutubeDL.latency = args.ytdl_latency
+    sessions.create_api = FakeTikTokApi
+    services.create_shazam = FakeShazam
+    # services.download_music_sync импортирует yt_dlp при вызове
+    sys.modules["yt_dlp"] = types.SimpleNamespace(YoutubeDL=FakeYoutubeDL)
+    services.create_http_client = lambda: create_local_client(fake_server.port)
+
+    urls = UrlFactory(args.seed)
+    results = []
+    try:
+        async with api.lifespan(api.app):
+            transport = httpx.ASGITransport(app=api.app)
+            async with httpx.AsyncClient(transport=transport, base_url="http://benchmark", timeout=300) as client:
+                for scenario in args.scenario or SCENARIOS:
+                    result = await run_scenario(client, urls, scenario, args.requests, args.concurrency)
+                    config.logger.info(f"Сценарий {scenario}: {result}")
+                    results.append(result)
+    finally:
+        fake_server.stop()
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description="Нагрузочный тест API на локальных заглушках TikTok, Shazam и YouTube.")
+    parser.add_argument("--scenario", action="append", choices=SCENARIOS, help="Сценарий (можно несколько раз). По умолчанию все.")
+    parser.add_argument("--requests", type=int, default=100, help="Запросов на сценарий.")
+    parser.add_argument("--concurrency", type=int, default=10, help="Одновременных запросов.")
+    parser.add_argument("--latency", type=float, default=0.02, help="Задержка ответов TikTok и CDN, сек.")
+    parser.add_argument("--shazam-latency", type=float, default=0.2, help="Задержка распознавания Shazam, сек.")
+    parser.add_argument("--ytdl-latency", type=float, default=0.5, help="Задержка скачивания трека yt-dlp, сек.")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", help="Сохранить результаты в JSON-файл.")
+    parser.add_argument("--keep-files", action="store_true", help="Не удалять временную папку с кэшем.")
+    args = parser.parse_args()
+
+    try:
+        results = asyncio.run(run_benchmark(args))
+    finally:
+        if not args.keep_files:
+            shutil.rmtree(BENCH_DIR, ignore_errors=True)
+    print_report(results)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,62 @@
+# python_api/cache.py
+
+import time
+from collections import OrderedDict
+
+# --- Счетчики кэша для всего процесса ---
+counters = {
+    "memory_hits": 0,
+    "db_hits": 0,
+    "misses": 0,
+    "album_hits": 0,
+    "short_url_memory_hits": 0,
+    "short_url_db_hits": 0,
+    "short_url_misses": 0,
+    "music_hits": 0,
+    "music_misses": 0,
+    "track_hits": 0,
+    "track_downloads": 0,
+}
+
+class LRUCache:
+    """Простой LRU-кэш в памяти с ограничением по размеру и времени жизни записи."""
+
+    def __init__(self, max_size: int, ttl: float | None = None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        item = self._data.get(key)
+        if item is None:
+            self.misses += 1
+            return default
+        expires_at, value = item
+        if expires_at is not None and expires_at < time.monotonic():
+            del self._data[key]
+            self.misses += 1
+            return default
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key, value):
+        if self.max_size <= 0:
+            return
+        expires_at = time.monotonic() + self.ttl if self.ttl else None
+        self._data[key] = (expires_at, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.max_size:
+            self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        item = self._data.pop(key, None)
+        return item[1] if item else default
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self) -> dict:
+        return {"size": len(self._data), "max_size": self.max_size, "hits": self.hits, "misses": self.misses}
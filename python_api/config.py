@@ -2,17 +2,43 @@
 
 import os
 import logging
+import contextvars
 from dotenv import load_dotenv
 
 # --- Загрузка .env и настройка логгирования ---
 load_dotenv()
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - [%(funcName)s] - %(message)s')
+
+# ID запроса попадает в каждую строку лога, в том числе из фоновых задач, запущенных этим запросом
+trace_id_var = contextvars.ContextVar("trace_id", default="-")
+
+class TraceIdFilter(logging.Filter):
+    def filter(self, record):
+        record.trace_id = trace_id_var.get()
+        return True
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - [%(trace_id)s] [%(funcName)s] - %(message)s')
+for handler in logging.getLogger().handlers:
+    handler.addFilter(TraceIdFilter())
 logger = logging.getLogger(__name__)
 
 # --- Основные переменные ---
 MS_TOKEN = os.environ.get("MS_TOKEN")
-if not MS_TOKEN:
+# Несколько токенов через запятую: на каждый создается TIKTOK_SESSIONS_PER_TOKEN сессий
+MS_TOKENS = [token.strip() for token in os.environ.get("MS_TOKENS", MS_TOKEN or "").split(",") if token.strip()]
+if not MS_TOKENS:
     raise ValueError("ms_token не найден в .env файле.")
+MS_TOKEN = MS_TOKEN or MS_TOKENS[0]
+
+TRACE_ID_HEADER = os.environ.get("TRACE_ID_HEADER", "X-Request-ID") # Пустое значение — не возвращать ID запроса клиенту
+
+# --- Настройки сессий TikTok ---
+TIKTOK_SESSIONS_PER_TOKEN = int(os.environ.get("TIKTOK_SESSIONS_PER_TOKEN", 1))
+TIKTOK_SLEEP_AFTER = int(os.environ.get("TIKTOK_SLEEP_AFTER", 3)) # Пауза после открытия страницы при создании сессии, сек
+TIKTOK_HEALTH_INTERVAL = int(os.environ.get("TIKTOK_HEALTH_INTERVAL", 120)) # Как часто проверять сессии, сек
+TIKTOK_PROBE_TIMEOUT = float(os.environ.get("TIKTOK_PROBE_TIMEOUT", 10))
+TIKTOK_MAX_FAILURES = int(os.environ.get("TIKTOK_MAX_FAILURES", 3)) # Ошибок подряд до пересоздания сессии
+TIKTOK_WARMUP_WAIT = float(os.environ.get("TIKTOK_WARMUP_WAIT", 60)) # Сколько запрос ждет запуска браузера, сек
+TIKTOK_COOKIE_TTL = int(os.environ.get("TIKTOK_COOKIE_TTL", 600)) # Сколько использовать cookies сессии без обновления, сек
 
 # --- Пути к файлам и папкам ---
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
@@ -20,8 +46,94 @@ DB_FILE = os.path.join(BASE_DIR, "cache.db")
 VIDEO_CACHE_DIR = os.path.join(BASE_DIR, "video_cache")
 AUDIO_DIR = os.path.join(BASE_DIR, "audio_files")
 TEMP_IMAGE_DIR = os.path.join(BASE_DIR, "temp_images") # <--- ВОТ ЭТА СТРОКА ДОБАВЛЕНА
+THUMB_DIR = os.path.join(BASE_DIR, "thumbnails")
+LOCK_DIR = os.path.join(BASE_DIR, "locks")
 TEMPLATE_FILE = os.path.join(BASE_DIR, "templates", "download_page.html")
 
+# --- Настройки SQLite ---
+DB_POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", 4)) # Соединения для чтения
+DB_WRITE_BATCH_INTERVAL = float(os.environ.get("DB_WRITE_BATCH_INTERVAL", 0.5)) # Как часто записывать отложенные изменения, сек
+DB_CACHE_SIZE_KB = int(os.environ.get("DB_CACHE_SIZE_KB", 16 * 1024))
+DB_MMAP_SIZE = int(os.environ.get("DB_MMAP_SIZE", 256 * 1024 ** 2))
+
+# --- Настройки кэша ---
+CACHE_RETENTION_DAYS = int(os.environ.get("CACHE_RETENTION_DAYS", 7))
+METADATA_CACHE_SIZE = int(os.environ.get("METADATA_CACHE_SIZE", 512)) # Сколько метаданных держать в памяти
+METADATA_CACHE_TTL = int(os.environ.get("METADATA_CACHE_TTL", 3600)) # Время жизни записи в памяти, сек
+CACHE_MAX_BYTES = int(os.environ.get("CACHE_MAX_BYTES", 10 * 1024 ** 3)) # Бюджет диска на видео, треки и фото
+CACHE_LOW_WATERMARK = float(os.environ.get("CACHE_LOW_WATERMARK", 0.9)) # До какой доли бюджета освобождать место
+TEMP_IMAGE_TTL = int(os.environ.get("TEMP_IMAGE_TTL", 24 * 60 * 60)) # Сколько хранить скачанные фотоальбомы, сек
+EVICTION_INTERVAL = int(os.environ.get("EVICTION_INTERVAL", 300)) # Как часто проверять кэш, сек
+EVICTION_BATCH = int(os.environ.get("EVICTION_BATCH", 100)) # Сколько файлов удалять за один запрос к БД
+SHORT_URL_CACHE_SIZE = int(os.environ.get("SHORT_URL_CACHE_SIZE", 4096)) # Раскрытые короткие ссылки в памяти
+SHORT_URL_CACHE_TTL = int(os.environ.get("SHORT_URL_CACHE_TTL", 3600))
+SHORT_URL_TTL = int(os.environ.get("SHORT_URL_TTL", 30 * 24 * 60 * 60)) # Сколько хранить раскрытую ссылку в БД, сек
+
+# --- Настройки фотоальбомов ---
+IMAGE_HOST_CONCURRENCY = int(os.environ.get("IMAGE_HOST_CONCURRENCY", 4)) # Одновременные загрузки с одного хоста
+IMAGE_MAX_BYTES = int(os.environ.get("IMAGE_MAX_BYTES", 30 * 1024 ** 2)) # Изображения больше этого размера не скачиваются
+IMAGE_REENCODE = os.environ.get("IMAGE_REENCODE", "false").lower() in ("1", "true", "yes") # Пережимать фото под лимиты Telegram
+IMAGE_MAX_SIDE = int(os.environ.get("IMAGE_MAX_SIDE", 2560)) # Максимальная сторона после пережатия, px
+IMAGE_JPEG_QUALITY = int(os.environ.get("IMAGE_JPEG_QUALITY", 90))
+TELEGRAM_PHOTO_MAX_BYTES = 10 * 1024 ** 2 # Лимит Telegram на размер фото
+
+# --- Настройки очереди задач ---
+MAX_CONCURRENT_JOBS = int(os.environ.get("MAX_CONCURRENT_JOBS", 4)) # Сколько разных видео обрабатывать одновременно
+JOB_WORKERS = int(os.environ.get("JOB_WORKERS", 4)) # Обработчики фоновых задач /jobs
+JOB_CALLBACK_TIMEOUT = float(os.environ.get("JOB_CALLBACK_TIMEOUT", 10))
+# Если задан — уведомления уходят только на эти хосты (и им разрешены внутренние адреса), иначе — на любые публичные адреса
+JOB_CALLBACK_ALLOWED_HOSTS = {host.strip().lower() for host in os.environ.get("JOB_CALLBACK_ALLOWED_HOSTS", "").split(",") if host.strip()}
+JOB_POLL_INTERVAL = float(os.environ.get("JOB_POLL_INTERVAL", 1)) # Как часто проверять очередь задач в БД, сек
+JOB_REQUEUE_INTERVAL = int(os.environ.get("JOB_REQUEUE_INTERVAL", 60)) # Как часто искать задачи упавших процессов, сек
+
+# --- Пакетная обработка /batch ---
+BATCH_MAX_URLS = int(os.environ.get("BATCH_MAX_URLS", 100)) # Максимум ссылок в одном запросе (вместе с лентой)
+BATCH_CONCURRENCY = int(os.environ.get("BATCH_CONCURRENCY", 4)) # Сколько постов пакета обрабатывать одновременно по умолчанию
+BATCH_MAX_CONCURRENCY = int(os.environ.get("BATCH_MAX_CONCURRENCY", 16)) # Верхняя граница concurrency из запроса
+BATCH_FEED_COUNT = int(os.environ.get("BATCH_FEED_COUNT", 30)) # Сколько видео брать из ленты автора, хэштега или звука по умолчанию
+
+# --- Несколько процессов uvicorn ---
+API_WORKERS = int(os.environ.get("API_WORKERS", 1)) # Больше 1 — отключает автоперезагрузку при изменении кода
+LOCK_STRIPES = int(os.environ.get("LOCK_STRIPES", 1024)) # Число файлов блокировок для ключей (видео, треки)
+LOCK_POLL_INTERVAL = float(os.environ.get("LOCK_POLL_INTERVAL", 0.1)) # Как часто проверять занятую блокировку, сек
+
+# --- Пулы для блокирующих задач ---
+IO_POOL_WORKERS = int(os.environ.get("IO_POOL_WORKERS", 8)) # Потоки для записи файлов
+CPU_POOL_WORKERS = int(os.environ.get("CPU_POOL_WORKERS", 2)) # Процессы для OpenCV (миниатюры, фото); 0 — выполнять в потоках
+MUSIC_POOL_WORKERS = int(os.environ.get("MUSIC_POOL_WORKERS", 2)) # Отдельные процессы для yt-dlp, чтобы долгие загрузки треков не занимали пул OpenCV
+EXECUTOR_TIMEOUT = int(os.environ.get("EXECUTOR_TIMEOUT", 300)) # Лимит времени одной тяжелой задачи, сек
+
+# --- Общий HTTP-клиент ---
+HTTP2_ENABLED = os.environ.get("HTTP2_ENABLED", "1") == "1"
+HTTP_MAX_CONNECTIONS = int(os.environ.get("HTTP_MAX_CONNECTIONS", 100))
+HTTP_MAX_KEEPALIVE = int(os.environ.get("HTTP_MAX_KEEPALIVE", 20))
+HTTP_KEEPALIVE_EXPIRY = float(os.environ.get("HTTP_KEEPALIVE_EXPIRY", 30))
+HTTP_TIMEOUT = float(os.environ.get("HTTP_TIMEOUT", 30))
+HTTP_CONNECT_TIMEOUT = float(os.environ.get("HTTP_CONNECT_TIMEOUT", 10))
+HTTP_RETRIES = int(os.environ.get("HTTP_RETRIES", 2))
+HTTP_BACKOFF = float(os.environ.get("HTTP_BACKOFF", 0.5)) # Базовая задержка между повторами, сек
+
+# --- Настройки скачивания видео ---
+VIDEO_MAX_BYTES = int(os.environ.get("VIDEO_MAX_BYTES", 0)) # 0 — без ограничения
+DOWNLOAD_CHUNK_SIZE = int(os.environ.get("DOWNLOAD_CHUNK_SIZE", 256 * 1024))
+DOWNLOAD_RETRIES = int(os.environ.get("DOWNLOAD_RETRIES", 2)) # Сколько раз докачивать после обрыва
+DOWNLOAD_RESUME = os.environ.get("DOWNLOAD_RESUME", "1") == "1" # Докачивать через Range вместо скачивания заново
+
+# --- Миниатюры видео ---
+THUMBNAIL_SIZES = [int(size) for size in os.environ.get("THUMBNAIL_SIZES", "320,720").split(",")] # Ширина в пикселях, 0 — исходная
+THUMBNAIL_DEFAULT_SIZE = int(os.environ.get("THUMBNAIL_DEFAULT_SIZE", 720))
+if THUMBNAIL_DEFAULT_SIZE not in THUMBNAIL_SIZES:
+    # Иначе /video_thumb без параметра size отвечал бы 400
+    logger.warning(f"THUMBNAIL_DEFAULT_SIZE={THUMBNAIL_DEFAULT_SIZE} нет в THUMBNAIL_SIZES, использую ближайший размер.")
+    THUMBNAIL_DEFAULT_SIZE = min(THUMBNAIL_SIZES, key=lambda size: abs(size - THUMBNAIL_DEFAULT_SIZE))
+THUMBNAIL_WEBP = os.environ.get("THUMBNAIL_WEBP", "1") == "1" # Дополнительно сохранять WebP
+THUMBNAIL_MAX_AGE = int(os.environ.get("THUMBNAIL_MAX_AGE", 365 * 24 * 60 * 60)) # Cache-Control для браузеров, сек
+
+# --- Распознавание музыки ---
+AUDIO_SEGMENT_SECONDS = float(os.environ.get("AUDIO_SEGMENT_SECONDS", 12)) # Длина фрагмента для Shazam
+AUDIO_SEGMENT_OFFSET = float(os.environ.get("AUDIO_SEGMENT_OFFSET", 0)) # С какой секунды брать фрагмент
+MUSIC_NEGATIVE_TTL = int(os.environ.get("MUSIC_NEGATIVE_TTL", 24 * 60 * 60)) # Сколько помнить, что звук не распознан, сек
+
 # --- Настройки yt-dlp ---
 YDL_OPTIONS = {
     'format': 'bestaudio/best',
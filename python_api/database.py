@@ -1,14 +1,62 @@
+import asyncio
 import sqlite3
 import aiosqlite
 import json
 import time
 import os
-from config import DB_FILE, logger
+from contextlib import asynccontextmanager
+from config import DB_FILE, SHORT_URL_TTL, logger
+import config
+import locks
+import metrics
+
+# --- Часто нужные поля метаданных вынесены в отдельные колонки, чтобы не разбирать JSON целиком ---
+HOT_COLUMNS = {
+    "author_unique_id": "$.author.uniqueId",
+    "author_avatar": "$.author.avatarThumb",
+    "description": "$.desc",
+    "music_id": "$.music.id",
+    "shazam_artist": "$.shazam.artist",
+    "shazam_title": "$.shazam.title",
+}
+
+UPSERT_CACHE_FILE_SQL = """
+    INSERT INTO cache_files (path, kind, owner_id, size_bytes, created_at, last_access) VALUES (?, ?, ?, ?, ?, ?)
+    ON CONFLICT(path) DO UPDATE SET size_bytes = excluded.size_bytes, last_access = excluded.last_access
+"""
+
+def extract_hot_columns(metadata: dict) -> tuple:
+    """Значения HOT_COLUMNS из метаданных в том же порядке, что и в словаре."""
+    values = []
+    for json_path in HOT_COLUMNS.values():
+        value = metadata
+        for key in json_path[2:].split("."):
+            value = value.get(key) if isinstance(value, dict) else None
+        values.append(str(value) if value is not None else None)
+    return tuple(values)
+
+def migrate_videos_table(cur):
+    """Добавляет колонки HOT_COLUMNS в старую таблицу videos и заполняет их из JSON."""
+    existing = {row[1] for row in cur.execute("PRAGMA table_info(videos)")}
+    missing = [column for column in HOT_COLUMNS if column not in existing]
+    if not missing:
+        return
+    logger.info(f"Миграция таблицы videos: добавляю колонки {', '.join(missing)}")
+    for column in missing:
+        cur.execute(f"ALTER TABLE videos ADD COLUMN {column} TEXT")
+    cur.execute("UPDATE videos SET " + ", ".join(f"{column} = json_extract(metadata, '{HOT_COLUMNS[column]}')" for column in missing))
 
 def init_db_sync():
+    # Несколько процессов uvicorn стартуют одновременно: миграции выполняет только один из них
+    with locks.file_lock_sync("init-db"):
+        _init_db_sync()
+
+def _init_db_sync():
     logger.info(f"Проверяем и инициализируем базу данных: {DB_FILE}")
     try:
         con = sqlite3.connect(DB_FILE)
+        # WAL сохраняется в файле БД: читатели больше не блокируют запись
+        con.execute("PRAGMA journal_mode=WAL")
         cur = con.cursor()
         cur.execute("""
             CREATE TABLE IF NOT EXISTS videos (
@@ -19,6 +67,96 @@ def init_db_sync():
                 created_at INTEGER NOT NULL
             )
         """)
+        migrate_videos_table(cur)
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_videos_created_at ON videos (created_at)")
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_videos_audio_file_path ON videos (audio_file_path)")
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS short_urls (
+                short_url TEXT PRIMARY KEY,
+                resolved_url TEXT NOT NULL,
+                video_id TEXT NOT NULL,
+                created_at INTEGER NOT NULL
+            )
+        """)
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS music_cache (
+                cache_key TEXT PRIMARY KEY,
+                shazam TEXT,
+                audio_file_path TEXT,
+                created_at INTEGER NOT NULL
+            )
+        """)
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS tracks (
+                track_id TEXT PRIMARY KEY,
+                name_key TEXT NOT NULL UNIQUE,
+                shazam_key TEXT,
+                artist TEXT,
+                title TEXT,
+                file_path TEXT NOT NULL,
+                ref_count INTEGER NOT NULL DEFAULT 0,
+                created_at INTEGER NOT NULL
+            )
+        """)
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_tracks_shazam_key ON tracks (shazam_key)")
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS albums (
+                album_id TEXT PRIMARY KEY,
+                metadata TEXT NOT NULL,
+                images TEXT NOT NULL,
+                dir_path TEXT NOT NULL,
+                created_at INTEGER NOT NULL
+            )
+        """)
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_tracks_file_path ON tracks (file_path)")
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                job_id TEXT PRIMARY KEY,
+                url TEXT NOT NULL,
+                status TEXT NOT NULL,
+                stage TEXT,
+                result TEXT,
+                error TEXT,
+                callback_url TEXT,
+                created_at INTEGER NOT NULL,
+                updated_at INTEGER NOT NULL
+            )
+        """)
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs (status, created_at)")
+        # PID процесса, который выполняет задачу: по нему находятся задачи упавших процессов
+        if "worker_pid" not in {row[1] for row in cur.execute("PRAGMA table_info(jobs)")}:
+            cur.execute("ALTER TABLE jobs ADD COLUMN worker_pid INTEGER")
+        # Индекс всех файлов кэша (видео, треки, папки с фото) для вытеснения без обхода папок
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS cache_files (
+                path TEXT PRIMARY KEY,
+                kind TEXT NOT NULL,
+                owner_id TEXT,
+                size_bytes INTEGER NOT NULL,
+                created_at INTEGER NOT NULL,
+                last_access INTEGER NOT NULL
+            )
+        """)
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_cache_files_last_access ON cache_files (last_access)")
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_cache_files_kind_created ON cache_files (kind, created_at)")
+        # Суммарный размер по видам файлов поддерживают триггеры, чтобы не считать SUM по всей таблице
+        cur.executescript("""
+            CREATE TABLE IF NOT EXISTS cache_usage (
+                kind TEXT PRIMARY KEY,
+                total_bytes INTEGER NOT NULL DEFAULT 0,
+                file_count INTEGER NOT NULL DEFAULT 0
+            );
+            CREATE TRIGGER IF NOT EXISTS cache_files_after_insert AFTER INSERT ON cache_files BEGIN
+                INSERT INTO cache_usage (kind, total_bytes, file_count) VALUES (NEW.kind, NEW.size_bytes, 1)
+                ON CONFLICT(kind) DO UPDATE SET total_bytes = total_bytes + excluded.total_bytes, file_count = file_count + 1;
+            END;
+            CREATE TRIGGER IF NOT EXISTS cache_files_after_update AFTER UPDATE OF size_bytes ON cache_files BEGIN
+                UPDATE cache_usage SET total_bytes = total_bytes + NEW.size_bytes - OLD.size_bytes WHERE kind = NEW.kind;
+            END;
+            CREATE TRIGGER IF NOT EXISTS cache_files_after_delete AFTER DELETE ON cache_files BEGIN
+                UPDATE cache_usage SET total_bytes = total_bytes - OLD.size_bytes, file_count = file_count - 1 WHERE kind = OLD.kind;
+            END;
+        """)
         con.commit()
         con.close()
         logger.info("База данных успешно инициализирована.")
@@ -26,12 +164,146 @@ def init_db_sync():
         logger.error(f"КРИТИЧЕСКАЯ ОШИБКА при инициализации БД: {e}", exc_info=True)
         raise
 
+# --- Пул соединений: несколько читателей и один писатель (WAL разрешает им работать одновременно) ---
+async def apply_pragmas(db: aiosqlite.Connection, read_only: bool = False):
+    await db.execute("PRAGMA synchronous=NORMAL")
+    await db.execute("PRAGMA busy_timeout=5000")
+    await db.execute("PRAGMA temp_store=MEMORY")
+    await db.execute(f"PRAGMA cache_size=-{config.DB_CACHE_SIZE_KB}")
+    await db.execute(f"PRAGMA mmap_size={config.DB_MMAP_SIZE}")
+    if read_only:
+        await db.execute("PRAGMA query_only=ON")
+
+class ConnectionPool:
+    """Долгоживущие соединения aiosqlite, открываемые один раз в lifespan."""
+
+    def __init__(self, size: int):
+        self.size = size
+        self._readers = asyncio.Queue()
+        self._writer = None
+        self._write_lock = asyncio.Lock()
+        self._pending_writes = []
+        self._flush_task = None
+
+    async def open(self):
+        for _ in range(self.size):
+            db = await aiosqlite.connect(DB_FILE)
+            await apply_pragmas(db, read_only=True)
+            self._readers.put_nowait(db)
+        self._writer = await aiosqlite.connect(DB_FILE)
+        await apply_pragmas(self._writer)
+        self._flush_task = asyncio.create_task(self._flush_loop())
+
+    async def close(self):
+        if self._flush_task:
+            self._flush_task.cancel()
+            await asyncio.gather(self._flush_task, return_exceptions=True)
+        await self.flush()
+        while not self._readers.empty():
+            await self._readers.get_nowait().close()
+        await self._writer.close()
+
+    @asynccontextmanager
+    async def reader(self):
+        started = time.monotonic()
+        db = await self._readers.get()
+        metrics.queue_wait_seconds.observe(time.monotonic() - started, queue="db_reader")
+        try:
+            yield db
+        finally:
+            self._readers.put_nowait(db)
+
+    @asynccontextmanager
+    async def writer(self):
+        started = time.monotonic()
+        async with self._write_lock:
+            metrics.queue_wait_seconds.observe(time.monotonic() - started, queue="db_writer")
+            try:
+                yield self._writer
+                await self._writer.commit()
+            except BaseException:
+                await self._writer.rollback()
+                raise
+
+    def write_later(self, sql: str, params: tuple):
+        self._pending_writes.append((sql, params))
+
+    async def flush(self):
+        """Записывает накопленные отложенные запросы одной транзакцией."""
+        if not self._pending_writes:
+            return
+        batch, self._pending_writes = self._pending_writes, []
+        async with self.writer() as db:
+            for sql, params in batch:
+                await db.execute(sql, params)
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(config.DB_WRITE_BATCH_INTERVAL)
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"Не удалось записать отложенные изменения в БД: {e}", exc_info=True)
+
+_pool: ConnectionPool | None = None
+
+async def open_pool():
+    global _pool
+    _pool = ConnectionPool(config.DB_POOL_SIZE)
+    await _pool.open()
+    logger.info(f"Пул соединений с БД открыт: читателей {config.DB_POOL_SIZE}.")
+
+def is_pool_open() -> bool:
+    return _pool is not None
+
+async def close_pool():
+    global _pool
+    if _pool:
+        await _pool.close()
+        _pool = None
+
+@asynccontextmanager
+async def reader():
+    """Соединение для чтения. Без открытого пула (например, в cleanup.py) открывает временное."""
+    if _pool:
+        async with _pool.reader() as db:
+            yield db
+    else:
+        async with aiosqlite.connect(DB_FILE) as db:
+            await apply_pragmas(db)
+            yield db
+
+@asynccontextmanager
+async def writer():
+    """Соединение для записи; изменения фиксируются при выходе из блока."""
+    if _pool:
+        async with _pool.writer() as db:
+            yield db
+    else:
+        async with aiosqlite.connect(DB_FILE) as db:
+            await apply_pragmas(db)
+            yield db
+            await db.commit()
+
+async def flush_writes():
+    """Немедленно записывает отложенные изменения, чтобы они не перезаписали более поздние."""
+    if _pool:
+        await _pool.flush()
+
+async def write_later(sql: str, params: tuple):
+    """Некритичная запись, которая уйдет в БД вместе с другими через DB_WRITE_BATCH_INTERVAL."""
+    if _pool:
+        _pool.write_later(sql, params)
+    else:
+        async with writer() as db:
+            await db.execute(sql, params)
+
 async def get_cached_video(video_id: str):
-    week_ago = int(time.time()) - 7 * 24 * 60 * 60
-    async with aiosqlite.connect(DB_FILE) as db:
+    # Срок хранения отсчитывается от последнего обращения и соблюдается вытеснением (eviction.py)
+    async with reader() as db:
         async with db.execute(
-            "SELECT video_file_path, metadata, audio_file_path FROM videos WHERE video_id = ? AND created_at >= ?",
-            (video_id, week_ago)
+            "SELECT video_file_path, metadata, audio_file_path FROM videos WHERE video_id = ?",
+            (video_id,)
         ) as cursor:
             cached = await cursor.fetchone()
 
@@ -59,10 +331,285 @@ async def get_cached_video(video_id: str):
     return None, None
 
 async def save_video_to_cache(video_id, metadata, video_file_path, audio_file_path):
-    async with aiosqlite.connect(DB_FILE) as db:
+    async with writer() as db:
+        async with db.execute("SELECT audio_file_path FROM videos WHERE video_id = ?", (video_id,)) as cursor:
+            previous = await cursor.fetchone()
+        previous_audio = previous[0] if previous else None
+        # Счетчик ссылок трека = число видео, у которых он указан в audio_file_path
+        if previous_audio != audio_file_path:
+            if previous_audio:
+                await db.execute("UPDATE tracks SET ref_count = MAX(ref_count - 1, 0) WHERE file_path = ?", (previous_audio,))
+            if audio_file_path:
+                await db.execute("UPDATE tracks SET ref_count = ref_count + 1 WHERE file_path = ?", (audio_file_path,))
+        now = int(time.time())
+        columns = ", ".join(HOT_COLUMNS)
         await db.execute(
-            "INSERT OR REPLACE INTO videos (video_id, metadata, video_file_path, audio_file_path, created_at) VALUES (?, ?, ?, ?, ?)",
-            (video_id, json.dumps(metadata), video_file_path, audio_file_path, int(time.time()))
+            f"INSERT OR REPLACE INTO videos (video_id, metadata, video_file_path, audio_file_path, created_at, {columns}) VALUES (?, ?, ?, ?, ?{', ?' * len(HOT_COLUMNS)})",
+            (video_id, json.dumps(metadata), video_file_path, audio_file_path, now, *extract_hot_columns(metadata))
         )
-        await db.commit()
-    logger.info(f"Сохранено в кэш: {video_id}")
\ No newline at end of file
+        await db.execute(UPSERT_CACHE_FILE_SQL, (video_file_path, "video", video_id, os.path.getsize(video_file_path), now, now))
+    logger.info(f"Сохранено в кэш: {video_id}")
+
+async def get_cached_album(album_id: str) -> tuple | None:
+    """Возвращает (папка альбома, метаданные, статусы изображений) или None."""
+    min_created_at = int(time.time()) - config.TEMP_IMAGE_TTL
+    async with reader() as db:
+        async with db.execute(
+            "SELECT dir_path, metadata, images FROM albums WHERE album_id = ? AND created_at >= ?",
+            (album_id, min_created_at)
+        ) as cursor:
+            row = await cursor.fetchone()
+    if row and os.path.isdir(row[0]):
+        return row[0], json.loads(row[1]), json.loads(row[2])
+    return None
+
+async def save_album(album_id: str, metadata: dict, images: list, dir_path: str, size_bytes: int):
+    now = int(time.time())
+    async with writer() as db:
+        await db.execute(
+            "INSERT OR REPLACE INTO albums (album_id, metadata, images, dir_path, created_at) VALUES (?, ?, ?, ?, ?)",
+            (album_id, json.dumps(metadata), json.dumps(images), dir_path, now)
+        )
+        await db.execute(UPSERT_CACHE_FILE_SQL, (dir_path, "images", album_id, size_bytes, now, now))
+    logger.info(f"Альбом сохранен в кэш: {album_id}")
+
+async def get_video_summary(video_id: str) -> dict | None:
+    """Только нужные странице скачивания поля, без разбора полного JSON метаданных."""
+    async with reader() as db:
+        async with db.execute(
+            f"SELECT {', '.join(HOT_COLUMNS)} FROM videos WHERE video_id = ?",
+            (video_id,)
+        ) as cursor:
+            row = await cursor.fetchone()
+    return dict(zip(HOT_COLUMNS, row)) if row else None
+
+async def get_resolved_url(short_url: str):
+    """Возвращает (раскрытая ссылка, ID видео) для короткой ссылки, если она раскрывалась недавно."""
+    min_created_at = int(time.time()) - SHORT_URL_TTL
+    async with reader() as db:
+        async with db.execute(
+            "SELECT resolved_url, video_id FROM short_urls WHERE short_url = ? AND created_at >= ?",
+            (short_url, min_created_at)
+        ) as cursor:
+            row = await cursor.fetchone()
+    return (row[0], row[1]) if row else None
+
+async def save_resolved_url(short_url: str, resolved_url: str, video_id: str):
+    async with writer() as db:
+        await db.execute(
+            "INSERT OR REPLACE INTO short_urls (short_url, resolved_url, video_id, created_at) VALUES (?, ?, ?, ?)",
+            (short_url, resolved_url, video_id, int(time.time()))
+        )
+
+async def get_music_cache(cache_key: str):
+    """Возвращает (результат Shazam, путь к MP3, время записи) по ключу звука или None."""
+    async with reader() as db:
+        async with db.execute(
+            "SELECT shazam, audio_file_path, created_at FROM music_cache WHERE cache_key = ?", (cache_key,)
+        ) as cursor:
+            row = await cursor.fetchone()
+    if not row:
+        return None
+    return (json.loads(row[0]) if row[0] else None), row[1], row[2]
+
+async def save_music_cache(cache_keys: list, shazam_result: dict | None, audio_file_path: str | None):
+    now = int(time.time())
+    shazam_json = json.dumps(shazam_result) if shazam_result else None
+    async with writer() as db:
+        await db.executemany(
+            "INSERT OR REPLACE INTO music_cache (cache_key, shazam, audio_file_path, created_at) VALUES (?, ?, ?, ?)",
+            [(key, shazam_json, audio_file_path, now) for key in cache_keys]
+        )
+
+async def find_track(shazam_key: str | None, name_key: str):
+    """Ищет скачанный трек по ключу Shazam или по нормализованному имени. Возвращает (track_id, путь) или None."""
+    async with reader() as db:
+        async with db.execute(
+            "SELECT track_id, file_path FROM tracks WHERE name_key = ? OR (shazam_key IS NOT NULL AND shazam_key = ?) LIMIT 1",
+            (name_key, shazam_key)
+        ) as cursor:
+            row = await cursor.fetchone()
+    return (row[0], row[1]) if row else None
+
+async def save_track(track_id: str, name_key: str, shazam_key: str | None, artist: str, title: str, file_path: str):
+    now = int(time.time())
+    async with writer() as db:
+        # Трек мог быть вытеснен и скачан заново в тот же файл: видео, которые на него ссылаются, уже есть в БД
+        await db.execute(
+            """INSERT INTO tracks (track_id, name_key, shazam_key, artist, title, file_path, created_at, ref_count)
+               VALUES (?, ?, ?, ?, ?, ?, ?, (SELECT COUNT(*) FROM videos WHERE audio_file_path = ?))
+               ON CONFLICT(track_id) DO UPDATE SET file_path = excluded.file_path, shazam_key = COALESCE(excluded.shazam_key, shazam_key)""",
+            (track_id, name_key, shazam_key, artist, title, file_path, now, file_path)
+        )
+        await db.execute(UPSERT_CACHE_FILE_SQL, (file_path, "track", track_id, os.path.getsize(file_path), now, now))
+
+# --- Фоновые задачи ---
+JOB_FIELDS = ("job_id", "url", "status", "stage", "result", "error", "callback_url", "created_at", "updated_at")
+
+async def create_job(job_id: str, url: str, callback_url: str | None):
+    now = int(time.time())
+    async with writer() as db:
+        await db.execute(
+            "INSERT INTO jobs (job_id, url, status, stage, callback_url, created_at, updated_at) VALUES (?, ?, 'queued', 'queued', ?, ?, ?)",
+            (job_id, url, callback_url, now, now)
+        )
+
+async def get_job(job_id: str) -> dict | None:
+    async with reader() as db:
+        async with db.execute(f"SELECT {', '.join(JOB_FIELDS)} FROM jobs WHERE job_id = ?", (job_id,)) as cursor:
+            row = await cursor.fetchone()
+    if not row:
+        return None
+    job = dict(zip(JOB_FIELDS, row))
+    job["result"] = json.loads(job["result"]) if job["result"] else None
+    return job
+
+async def update_job(job_id: str, status: str | None = None, stage: str | None = None, result: dict | None = None, error: str | None = None, batched: bool = False):
+    updates = {"updated_at": int(time.time())}
+    if status is not None: updates["status"] = status
+    if stage is not None: updates["stage"] = stage
+    if result is not None: updates["result"] = json.dumps(result)
+    if error is not None: updates["error"] = error
+    sql = f"UPDATE jobs SET {', '.join(f'{field} = ?' for field in updates)} WHERE job_id = ?"
+    if batched:
+        await write_later(sql, (*updates.values(), job_id))
+        return
+    await flush_writes()
+    async with writer() as db:
+        await db.execute(sql, (*updates.values(), job_id))
+
+async def has_queued_jobs() -> bool:
+    """Дешевая проверка очереди через читателя: пустая очередь не занимает блокировку записи."""
+    async with reader() as db:
+        async with db.execute("SELECT 1 FROM jobs WHERE status = 'queued' LIMIT 1") as cursor:
+            return await cursor.fetchone() is not None
+
+async def claim_next_job(worker_pid: int) -> str | None:
+    """Атомарно забирает самую старую задачу из очереди. Несколько процессов никогда не получат одну задачу."""
+    async with writer() as db:
+        async with db.execute(
+            """UPDATE jobs SET status = 'running', worker_pid = ?, updated_at = ?
+               WHERE job_id = (SELECT job_id FROM jobs WHERE status = 'queued' ORDER BY created_at LIMIT 1) AND status = 'queued'
+               RETURNING job_id""",
+            (worker_pid, int(time.time()))
+        ) as cursor:
+            row = await cursor.fetchone()
+    return row[0] if row else None
+
+def is_process_alive(pid: int | None) -> bool:
+    if not pid:
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+async def requeue_orphaned_jobs(running_here: set) -> int:
+    """Возвращает в очередь задачи процессов, которые завершились, не доделав их.
+    running_here — задачи, которые прямо сейчас выполняет текущий процесс."""
+    async with reader() as db:
+        async with db.execute("SELECT job_id, worker_pid FROM jobs WHERE status = 'running'") as cursor:
+            rows = await cursor.fetchall()
+    orphaned = [
+        job_id for job_id, pid in rows
+        if (pid == os.getpid() and job_id not in running_here) or (pid != os.getpid() and not is_process_alive(pid))
+    ]
+    if orphaned:
+        async with writer() as db:
+            await db.executemany(
+                "UPDATE jobs SET status = 'queued', worker_pid = NULL WHERE job_id = ? AND status = 'running'",
+                [(job_id,) for job_id in orphaned]
+            )
+    return len(orphaned)
+
+# --- Индекс файлов кэша для вытеснения ---
+def backfill_cache_files_sync(extra_files: list):
+    """Однократно заполняет индекс файлов кэша для данных, скачанных до его появления.
+    extra_files — [(путь, вид)] файлов, которых нет в таблицах videos и tracks."""
+    con = sqlite3.connect(DB_FILE)
+    try:
+        if con.execute("SELECT 1 FROM cache_files LIMIT 1").fetchone():
+            return 0
+        entries = con.execute("SELECT video_file_path, 'video', video_id, created_at FROM videos").fetchall()
+        entries += con.execute("SELECT file_path, 'track', track_id, created_at FROM tracks").fetchall()
+        known = {entry[0] for entry in entries}
+        now = int(time.time())
+        entries += [(path, kind, None, now) for path, kind in extra_files if path not in known]
+        rows = []
+        for path, kind, owner_id, created_at in entries:
+            if not os.path.exists(path): continue
+            if os.path.isdir(path):
+                size = sum(entry.stat().st_size for entry in os.scandir(path) if entry.is_file())
+            else:
+                size = os.path.getsize(path)
+            rows.append((path, kind, owner_id, size, created_at, created_at))
+        con.executemany(UPSERT_CACHE_FILE_SQL, rows)
+        con.commit()
+        return len(rows)
+    finally:
+        con.close()
+
+async def register_cache_file(path: str, kind: str, owner_id: str | None, size_bytes: int):
+    now = int(time.time())
+    async with writer() as db:
+        await db.execute(UPSERT_CACHE_FILE_SQL, (path, kind, owner_id, size_bytes, now, now))
+
+async def touch_cache_files(accesses: dict):
+    """Обновляет время последнего обращения пачкой: {путь: время}."""
+    for path, accessed_at in accesses.items():
+        await write_later("UPDATE cache_files SET last_access = MAX(last_access, ?) WHERE path = ?", (accessed_at, path))
+
+async def get_cache_usage() -> dict:
+    async with reader() as db:
+        async with db.execute("SELECT kind, total_bytes, file_count FROM cache_usage") as cursor:
+            rows = await cursor.fetchall()
+    return {kind: {"bytes": total_bytes, "files": file_count} for kind, total_bytes, file_count in rows}
+
+# Трек, на который ссылаются видео в кэше, не вытесняется: он уйдет после вытеснения последнего такого видео
+EVICTABLE_SQL = "(kind != 'track' OR NOT EXISTS (SELECT 1 FROM tracks WHERE tracks.file_path = cache_files.path AND tracks.ref_count > 0))"
+
+async def get_expired_cache_files(last_access_before: int, images_created_before: int, limit: int) -> list:
+    """Файлы, к которым давно не обращались, и устаревшие папки с фото. Оба запроса идут по индексам."""
+    async with reader() as db:
+        async with db.execute(
+            f"SELECT path, kind, owner_id, size_bytes, last_access FROM cache_files WHERE last_access < ? AND {EVICTABLE_SQL} ORDER BY last_access LIMIT ?",
+            (last_access_before, limit)
+        ) as cursor:
+            rows = await cursor.fetchall()
+        async with db.execute(
+            "SELECT path, kind, owner_id, size_bytes, last_access FROM cache_files WHERE kind = 'images' AND created_at < ? LIMIT ?",
+            (images_created_before, limit)
+        ) as cursor:
+            rows += await cursor.fetchall()
+    return rows
+
+async def get_least_recent_cache_files(limit: int) -> list:
+    async with reader() as db:
+        async with db.execute(
+            f"SELECT path, kind, owner_id, size_bytes, last_access FROM cache_files WHERE {EVICTABLE_SQL} ORDER BY last_access LIMIT ?", (limit,)
+        ) as cursor:
+            return await cursor.fetchall()
+
+async def delete_cache_entry(path: str, kind: str, owner_id: str | None) -> dict:
+    """Удаляет запись о файле и связанные с ним строки (видео, трек или альбом).
+    Возвращает {путь: размер} действительно удаленных записей индекса кэша."""
+    removed = {}
+    async with writer() as db:
+        if kind == "video":
+            async with db.execute("SELECT audio_file_path FROM videos WHERE video_id = ?", (owner_id,)) as cursor:
+                row = await cursor.fetchone()
+            if row and row[0]:
+                await db.execute("UPDATE tracks SET ref_count = MAX(ref_count - 1, 0) WHERE file_path = ?", (row[0],))
+            await db.execute("DELETE FROM videos WHERE video_id = ?", (owner_id,))
+            async with db.execute("DELETE FROM cache_files WHERE kind = 'thumbs' AND owner_id = ? RETURNING path, size_bytes", (owner_id,)) as cursor:
+                removed.update(await cursor.fetchall())
+        elif kind == "track":
+            await db.execute("DELETE FROM tracks WHERE file_path = ?", (path,))
+        elif kind == "images":
+            await db.execute("DELETE FROM albums WHERE album_id = ?", (owner_id,))
+        async with db.execute("DELETE FROM cache_files WHERE path = ? RETURNING path, size_bytes", (path,)) as cursor:
+            removed.update(await cursor.fetchall())
+    return removed
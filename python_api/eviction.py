@@ -0,0 +1,137 @@
+# python_api/eviction.py
+
+import asyncio
+import os
+import shutil
+import time
+import config
+import database
+import executors
+import locks
+from config import logger
+
+# --- Обращения к файлам копятся в памяти и записываются в БД пачкой ---
+_pending_touches = {}
+
+def touch(path: str):
+    """Отмечает обращение к файлу кэша. Запись в БД происходит при следующем проходе вытеснения."""
+    _pending_touches[path] = int(time.time())
+
+async def flush_touches():
+    if not _pending_touches: return
+    accesses = dict(_pending_touches)
+    _pending_touches.clear()
+    await database.touch_cache_files(accesses)
+
+def remove_path(path: str):
+    if os.path.isdir(path):
+        shutil.rmtree(path, ignore_errors=True)
+    elif os.path.exists(path):
+        os.remove(path)
+
+def list_untracked_files() -> list:
+    """Файлы, скачанные до появления индекса: старые MP3 и папки с фото."""
+    files = []
+    if os.path.isdir(config.AUDIO_DIR):
+        files += [(entry.path, "track") for entry in os.scandir(config.AUDIO_DIR) if entry.name.endswith(".mp3")]
+    if os.path.isdir(config.TEMP_IMAGE_DIR):
+        files += [(entry.path, "images") for entry in os.scandir(config.TEMP_IMAGE_DIR) if entry.is_dir()]
+    return files
+
+class EvictionManager:
+    """Держит кэш (видео, треки, фото) в пределах бюджета диска, удаляя давно не используемые файлы."""
+
+    def __init__(self):
+        self._task = None
+        # Вытеснением занимается один процесс, остальные только записывают свои обращения к файлам
+        self.leader = locks.LeaderLock("eviction")
+        self.evicted_files = 0
+        self.evicted_bytes = 0
+        self.last_run_at = None
+
+    async def start(self):
+        if self.leader.try_acquire():
+            await self.backfill()
+        self._task = asyncio.create_task(self._loop())
+
+    async def backfill(self):
+        indexed = await executors.run_io(lambda: database.backfill_cache_files_sync(list_untracked_files()))
+        if indexed:
+            logger.info(f"В индекс кэша добавлено файлов, скачанных ранее: {indexed}.")
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+        await flush_touches()
+        self.leader.release()
+
+    async def _loop(self):
+        while True:
+            try:
+                if self.leader.try_acquire():
+                    await self.run_once()
+                else:
+                    await flush_touches()
+            except Exception as e:
+                logger.error(f"Ошибка при очистке кэша: {e}", exc_info=True)
+            await asyncio.sleep(config.EVICTION_INTERVAL)
+
+    async def run_once(self):
+        await flush_touches()
+        now = int(time.time())
+        self.last_run_at = now
+
+        # 1. Устаревшие файлы: по индексам last_access и (kind, created_at)
+        expired = await database.get_expired_cache_files(
+            last_access_before=now - config.CACHE_RETENTION_DAYS * 24 * 60 * 60,
+            images_created_before=now - config.TEMP_IMAGE_TTL,
+            limit=config.EVICTION_BATCH,
+        )
+        # Вместе с видео удаляются его миниатюры: их строки в этом же проходе пропускаются
+        removed = {}
+        for row in expired:
+            if row[0] not in removed:
+                removed.update(await self._evict(*row))
+
+        # 2. Бюджет диска: вытесняем до нижней границы, начиная с давно не используемых и крупных файлов
+        total = sum(usage["bytes"] for usage in (await database.get_cache_usage()).values())
+        if total <= config.CACHE_MAX_BYTES:
+            return
+        target = config.CACHE_MAX_BYTES * config.CACHE_LOW_WATERMARK
+        logger.info(f"Кэш занимает {total / 1024 ** 3:.2f} ГБ при лимите {config.CACHE_MAX_BYTES / 1024 ** 3:.2f} ГБ, освобождаю место.")
+        while total > target:
+            candidates = await database.get_least_recent_cache_files(config.EVICTION_BATCH)
+            if not candidates: break
+            # Среди самых старых первыми уходят те, у кого больше "возраст × размер"
+            candidates.sort(key=lambda row: (now - row[4] + 1) * row[3], reverse=True)
+            for row in candidates:
+                if row[0] in removed: continue
+                freed = await self._evict(*row)
+                removed.update(freed)
+                total -= sum(freed.values())
+                if total <= target: break
+
+    async def _evict(self, path: str, kind: str, owner_id: str | None, size_bytes: int, last_access: int) -> dict:
+        """Удаляет файл и его записи в БД. Возвращает {путь: размер} всего, что было освобождено."""
+        try:
+            await executors.run_io(remove_path, path)
+            if kind == "video" and owner_id:
+                # Миниатюры без видео не нужны
+                await executors.run_io(remove_path, os.path.join(config.THUMB_DIR, owner_id))
+        except OSError as e:
+            logger.warning(f"Не удалось удалить {path}: {e}")
+        removed = await database.delete_cache_entry(path, kind, owner_id)
+        self.evicted_files += len(removed)
+        self.evicted_bytes += sum(removed.values())
+        logger.info(f"Удален из кэша ({kind}): {path}")
+        return removed
+
+    async def stats(self) -> dict:
+        return {
+            "usage": await database.get_cache_usage(),
+            "max_bytes": config.CACHE_MAX_BYTES,
+            "evicted_files": self.evicted_files,
+            "evicted_bytes": self.evicted_bytes,
+            "last_run_at": self.last_run_at,
+        }
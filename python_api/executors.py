@@ -0,0 +1,119 @@
+# python_api/executors.py
+
+import asyncio
+import functools
+import multiprocessing
+import time
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from config import logger, IO_POOL_WORKERS, CPU_POOL_WORKERS, MUSIC_POOL_WORKERS, EXECUTOR_TIMEOUT
+
+# --- Пулы: "io" — потоки для файловых операций, "cpu" — процессы для OpenCV, "music" — процессы для yt-dlp ---
+_pools = {}
+PROCESS_POOL_WORKERS = {"cpu": CPU_POOL_WORKERS, "music": MUSIC_POOL_WORKERS}
+
+class PoolStats:
+    """Счетчики и время выполнения задач в одном пуле."""
+
+    def __init__(self):
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.timeouts = 0
+        self.active = 0
+        self.total_seconds = 0.0
+        self.max_seconds = 0.0
+
+    def as_dict(self) -> dict:
+        finished = self.completed + self.failed
+        return {
+            "submitted": self.submitted,
+            "completed": self.completed,
+            "failed": self.failed,
+            "timeouts": self.timeouts,
+            "active": self.active,
+            "avg_seconds": round(self.total_seconds / finished, 4) if finished else 0.0,
+            "max_seconds": round(self.max_seconds, 4),
+        }
+
+stats = {"io": PoolStats(), "cpu": PoolStats(), "music": PoolStats()}
+
+def _create_process_pool(kind: str):
+    workers = PROCESS_POOL_WORKERS[kind]
+    if workers <= 0:
+        # Процессы отключены — тяжелые задачи уходят в пул потоков
+        return _pools["io"]
+    # spawn вместо fork: дочерний процесс не наследует event loop и потоки uvicorn
+    return ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+
+def _recycle_process_pool(kind: str, pool):
+    """Заменяет пул процессов новым. Процессы старого пула завершаются: shutdown не прерывает уже идущие задачи,
+    и зависший yt-dlp или OpenCV занимал бы процесс до конца. Остальные задачи старого пула получат BrokenProcessPool."""
+    if _pools.get(kind) is not pool or not isinstance(pool, ProcessPoolExecutor):
+        return
+    _pools[kind] = _create_process_pool(kind)
+    processes = list((pool._processes or {}).values())
+    pool.shutdown(wait=False, cancel_futures=True)
+    for process in processes:
+        if process.is_alive():
+            process.terminate()
+
+def start():
+    if _pools: return
+    _pools["io"] = ThreadPoolExecutor(max_workers=IO_POOL_WORKERS, thread_name_prefix="io-pool")
+    for kind in PROCESS_POOL_WORKERS:
+        _pools[kind] = _create_process_pool(kind)
+    logger.info(f"Пулы запущены: потоков {IO_POOL_WORKERS}, процессов {CPU_POOL_WORKERS} для OpenCV и {MUSIC_POOL_WORKERS} для yt-dlp.")
+
+def shutdown():
+    for pool in {id(p): p for p in _pools.values()}.values():
+        pool.shutdown(wait=False, cancel_futures=True)
+    _pools.clear()
+
+async def _run(kind: str, func, *args, timeout: float | None = None, **kwargs):
+    if not _pools: start()
+    pool_stats = stats[kind]
+    pool_stats.submitted += 1
+    pool_stats.active += 1
+    started = time.monotonic()
+    pool = _pools[kind]
+    try:
+        call = functools.partial(func, *args, **kwargs)
+        result = await asyncio.wait_for(asyncio.get_running_loop().run_in_executor(pool, call), timeout)
+        pool_stats.completed += 1
+        return result
+    except asyncio.TimeoutError:
+        pool_stats.timeouts += 1
+        pool_stats.failed += 1
+        logger.error(f"Задача {getattr(func, '__name__', func)} в пуле '{kind}' не уложилась в {timeout} сек.")
+        if kind in PROCESS_POOL_WORKERS: _recycle_process_pool(kind, pool)
+        raise
+    except BrokenProcessPool:
+        pool_stats.failed += 1
+        if _pools.get(kind) is pool:
+            logger.error(f"Процесс пула '{kind}' аварийно завершился, пересоздаю пул.")
+            _recycle_process_pool(kind, pool)
+        raise
+    except Exception:
+        pool_stats.failed += 1
+        raise
+    finally:
+        elapsed = time.monotonic() - started
+        pool_stats.active -= 1
+        pool_stats.total_seconds += elapsed
+        pool_stats.max_seconds = max(pool_stats.max_seconds, elapsed)
+
+async def run_io(func, *args, **kwargs):
+    """Выполняет блокирующую функцию ввода-вывода в пуле потоков."""
+    return await _run("io", func, *args, **kwargs)
+
+async def run_cpu(func, *args, **kwargs):
+    """Выполняет тяжелую функцию в пуле процессов. Функция и аргументы должны сериализоваться pickle."""
+    return await _run("cpu", func, *args, timeout=EXECUTOR_TIMEOUT or None, **kwargs)
+
+async def run_music(func, *args, **kwargs):
+    """Как run_cpu, но в отдельном пуле для yt-dlp: скачивание трека упирается в сеть и длится десятки секунд."""
+    return await _run("music", func, *args, timeout=EXECUTOR_TIMEOUT or None, **kwargs)
+
+def get_stats() -> dict:
+    return {kind: pool_stats.as_dict() for kind, pool_stats in stats.items()}
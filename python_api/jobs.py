@@ -0,0 +1,137 @@
+# python_api/jobs.py
+
+import asyncio
+import os
+import time
+import uuid
+import config
+import database
+import metrics
+import services
+from config import logger
+
+class JobManager:
+    """Фоновая обработка ссылок: задачи хранятся в cache.db и переживают перезапуск сервиса.
+    Очередь — сама таблица jobs, поэтому задачи разбирают обработчики всех процессов uvicorn.
+    В каждом процессе очередь опрашивает один поллер и забирает задачи только для свободных обработчиков."""
+
+    def __init__(self, process, http_client, workers: int):
+        # process(url, on_progress) -> dict — полный цикл обработки одной ссылки
+        self._process = process
+        self._http = http_client
+        self._workers_count = workers
+        self._wakeup = asyncio.Event()
+        self._claimed = asyncio.Queue()
+        self._idle = 0
+        self._running = set()
+        # Захват задачи и поиск осиротевших задач не должны пересекаться: иначе сборщик увидит
+        # только что захваченную задачу этого процесса до того, как она попадет в _running
+        self._claim_lock = asyncio.Lock()
+        self._tasks = []
+
+    async def start(self):
+        # Задачи, прерванные перезапуском или падением процесса, возвращаются в очередь
+        if requeued := await database.requeue_orphaned_jobs(self._running):
+            logger.info(f"Возвращено в очередь прерванных задач: {requeued}.")
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self._workers_count)]
+        self._tasks.append(asyncio.create_task(self._poller()))
+        self._tasks.append(asyncio.create_task(self._reaper()))
+        logger.info(f"Запущено обработчиков задач: {self._workers_count}.")
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def submit(self, url: str, callback_url: str | None = None) -> str:
+        job_id = uuid.uuid4().hex
+        await database.create_job(job_id, url, callback_url)
+        # Поллер этого процесса забирает задачу сразу, остальные процессы — при следующем опросе
+        self._wakeup.set()
+        return job_id
+
+    def stats(self) -> dict:
+        return {"workers": self._workers_count, "running": len(self._running)}
+
+    async def _poller(self):
+        while True:
+            try:
+                # Сначала проверяем очередь через читателя, транзакция записи нужна только для захвата задачи
+                while self._idle > self._claimed.qsize() and await database.has_queued_jobs():
+                    async with self._claim_lock:
+                        job_id = await database.claim_next_job(os.getpid())
+                        if not job_id:
+                            break
+                        self._running.add(job_id)
+                    self._claimed.put_nowait(job_id)
+            except Exception as e:
+                logger.error(f"Не удалось проверить очередь задач: {e}", exc_info=True)
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), config.JOB_POLL_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+
+    async def _worker(self):
+        while True:
+            self._idle += 1
+            try:
+                job_id = await self._claimed.get()
+            finally:
+                self._idle -= 1
+            try:
+                await self._run(job_id)
+            except Exception as e:
+                logger.error(f"Сбой обработчика задачи {job_id}: {e}", exc_info=True)
+            finally:
+                self._running.discard(job_id)
+                # Обработчик освободился: не ждем следующего опроса
+                self._wakeup.set()
+
+    async def _reaper(self):
+        while True:
+            await asyncio.sleep(config.JOB_REQUEUE_INTERVAL)
+            try:
+                async with self._claim_lock:
+                    requeued = await database.requeue_orphaned_jobs(self._running)
+                if requeued:
+                    logger.warning(f"Возвращено в очередь задач завершившихся процессов: {requeued}.")
+                    self._wakeup.set()
+            except Exception as e:
+                logger.error(f"Не удалось проверить зависшие задачи: {e}", exc_info=True)
+
+    async def _run(self, job_id: str):
+        job = await database.get_job(job_id)
+        if not job:
+            return
+        # Строки лога этой задачи помечаются ее ID
+        config.trace_id_var.set(job_id)
+        metrics.queue_wait_seconds.observe(max(time.time() - job["created_at"], 0), queue="jobs")
+        await database.update_job(job_id, stage="resolve")
+
+        async def on_progress(stage: str, partial_result: dict):
+            await database.update_job(job_id, stage=stage, result=partial_result, batched=True)
+
+        try:
+            result = await self._process(job["url"], on_progress)
+            await database.update_job(job_id, status="done", stage="done", result=result)
+        except Exception as e:
+            # HTTPException несет понятное пользователю описание в detail
+            error = getattr(e, "detail", None) or str(e) or type(e).__name__
+            logger.warning(f"Задача {job_id} завершилась с ошибкой: {error}")
+            await database.update_job(job_id, status="failed", error=error)
+
+        if job["callback_url"]:
+            await self._send_callback(job["callback_url"], await database.get_job(job_id))
+
+    async def _send_callback(self, callback_url: str, job: dict):
+        try:
+            # Адрес проверялся при создании задачи, но DNS с тех пор мог начать указывать во внутреннюю сеть
+            await services.check_callback_url(callback_url)
+            response = await services.request_with_retry(
+                self._http, "POST", callback_url, json=job, timeout=config.JOB_CALLBACK_TIMEOUT, follow_redirects=False
+            )
+            response.raise_for_status()
+        except Exception as e:
+            logger.warning(f"Не удалось отправить уведомление о задаче {job['job_id']} на {callback_url}: {e}")
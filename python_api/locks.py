@@ -0,0 +1,76 @@
+# python_api/locks.py
+
+import asyncio
+import fcntl
+import os
+import time
+import zlib
+from contextlib import asynccontextmanager, contextmanager
+import config
+import metrics
+
+# --- Блокировки между процессами uvicorn на одном сервере (flock на файлах в LOCK_DIR) ---
+def _lock_path(name: str) -> str:
+    os.makedirs(config.LOCK_DIR, exist_ok=True)
+    return os.path.join(config.LOCK_DIR, f"{name}.lock")
+
+def striped(prefix: str, key: str) -> str:
+    """Имя блокировки для ключа. Ключи делятся на LOCK_STRIPES файлов, чтобы не плодить файл на каждое видео."""
+    return f"{prefix}-{zlib.crc32(key.encode('utf-8')) % config.LOCK_STRIPES}"
+
+@contextmanager
+def file_lock_sync(name: str):
+    """Блокирующий вариант для синхронного кода (например, инициализации БД)."""
+    fd = os.open(_lock_path(name), os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        yield
+    finally:
+        os.close(fd)
+
+@asynccontextmanager
+async def file_lock(name: str):
+    """Эксклюзивная блокировка по имени. Ожидание идет опросом и не блокирует event loop."""
+    fd = os.open(_lock_path(name), os.O_RDWR | os.O_CREAT, 0o644)
+    started = time.monotonic()
+    try:
+        while True:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                break
+            except BlockingIOError:
+                await asyncio.sleep(config.LOCK_POLL_INTERVAL)
+        metrics.queue_wait_seconds.observe(time.monotonic() - started, queue="file_lock")
+        yield
+    finally:
+        # Закрытие дескриптора снимает flock
+        os.close(fd)
+
+class LeaderLock:
+    """Роль, которую в каждый момент выполняет только один процесс (например, вытеснение кэша).
+    Блокировка держится, пока процесс жив; после его смерти ее подхватит другой процесс."""
+
+    def __init__(self, name: str):
+        self.name = name
+        self._fd = None
+
+    @property
+    def is_leader(self) -> bool:
+        return self._fd is not None
+
+    def try_acquire(self) -> bool:
+        if self._fd is not None:
+            return True
+        fd = os.open(_lock_path(self.name), os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            return False
+        self._fd = fd
+        return True
+
+    def release(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
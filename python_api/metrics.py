@@ -0,0 +1,115 @@
+# python_api/metrics.py
+
+import bisect
+import time
+from contextlib import contextmanager
+
+# --- Метрики в текстовом формате Prometheus без сторонних зависимостей ---
+_registry = []
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def _format_labels(label_names: tuple, label_values: tuple, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(label_names, label_values)]
+    if extra: pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+class Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, documentation: str, labels: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(labels)
+        _registry.append(self)
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(labels.get(name, "") for name in self.label_names)
+
+    def samples(self) -> list:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        lines += [f"{name}{labels} {value}" for name, labels, value in self.samples()]
+        return "\n".join(lines)
+
+class Counter(Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labels: tuple = ()):
+        super().__init__(name, documentation, labels)
+        self._values = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self) -> list:
+        return [(self.name, _format_labels(self.label_names, key), value) for key, value in self._values.items()]
+
+class Gauge(Metric):
+    """Значение считывается в момент запроса /metrics: collect() -> {значения меток: число}.
+    kind="counter" — для счетчиков, которые уже ведутся в других модулях."""
+    kind = "gauge"
+
+    def __init__(self, name: str, documentation: str, labels: tuple = (), collect=None, kind: str = "gauge"):
+        super().__init__(name, documentation, labels)
+        self._collect = collect
+        self.kind = kind
+
+    def samples(self) -> list:
+        try:
+            values = self._collect() if self._collect else {}
+        except Exception:
+            values = {}
+        return [(self.name, _format_labels(self.label_names, key if isinstance(key, tuple) else (key,)), value) for key, value in values.items()]
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labels: tuple = (), buckets: tuple = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets))
+        self._values = {}
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        counts, total = self._values.get(key, ([0] * (len(self.buckets) + 1), 0.0))
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        self._values[key] = (counts, total + value)
+
+    def samples(self) -> list:
+        samples = []
+        for key, (counts, total) in self._values.items():
+            cumulative = 0
+            for bound, count in zip((*self.buckets, "+Inf"), counts):
+                cumulative += count
+                samples.append((f"{self.name}_bucket", _format_labels(self.label_names, key, f'le="{bound}"'), cumulative))
+            samples.append((f"{self.name}_sum", _format_labels(self.label_names, key), round(total, 6)))
+            samples.append((f"{self.name}_count", _format_labels(self.label_names, key), cumulative))
+        return samples
+
+def render() -> str:
+    return "\n".join(metric.render() for metric in _registry) + "\n"
+
+# --- Метрики конвейера обработки ---
+stage_seconds = Histogram("tiktok_stage_duration_seconds", "Время этапов обработки поста.", labels=("stage", "outcome"))
+http_request_seconds = Histogram("tiktok_http_request_duration_seconds", "Время обработки HTTP-запросов к API.", labels=("method", "route", "status"))
+bytes_downloaded = Counter("tiktok_downloaded_bytes_total", "Скачано байт с внешних источников.", labels=("kind",))
+queue_wait_seconds = Histogram("tiktok_queue_wait_seconds", "Ожидание в очередях и блокировках.", labels=("queue",))
+batch_items = Counter("tiktok_batch_items_total", "Элементы пакетных запросов /batch по итогу обработки.", labels=("status",))
+
+@contextmanager
+def stage(name: str):
+    """Замеряет этап обработки: with metrics.stage("video_download"): ..."""
+    started = time.monotonic()
+    outcome = "error"
+    try:
+        yield
+        outcome = "ok"
+    finally:
+        stage_seconds.observe(time.monotonic() - started, stage=name, outcome=outcome)
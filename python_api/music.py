@@ -0,0 +1,110 @@
+# python_api/music.py
+
+import hashlib
+import os
+import re
+import time
+import unicodedata
+import cache
+import config
+import database
+import eviction
+import locks
+import metrics
+import scheduler
+import services
+
+# Одновременные запросы одного трека скачивают его один раз
+track_downloads = scheduler.JobScheduler(max(config.MUSIC_POOL_WORKERS, 1), name="tracks")
+
+# --- Хранилище треков: один файл на уникальную песню ---
+def normalize_track_name(artist: str, title: str) -> str:
+    """Ключ трека: исполнитель и название без регистра, пунктуации и лишних пробелов."""
+    def normalize(value: str) -> str:
+        value = unicodedata.normalize("NFKC", value or "").casefold()
+        value = re.sub(r"[^\w\s]", " ", value)
+        return " ".join(value.split())
+    return f"{normalize(artist)}|{normalize(title)}"
+
+async def get_or_download_track(shazam_result: dict) -> str | None:
+    """Возвращает путь к MP3 трека из хранилища, скачивая его с YouTube только если трека еще нет."""
+    artist, title = shazam_result.get("artist", ""), shazam_result.get("title", "")
+    name_key = normalize_track_name(artist, title)
+    if (track := await database.find_track(shazam_result.get("key"), name_key)) and os.path.exists(track[1]):
+        cache.counters["track_hits"] += 1
+        eviction.touch(track[1])
+        return track[1]
+
+    # Имя файла выводится из ключа трека, поэтому одна песня всегда лежит в одном файле
+    track_id = hashlib.sha1(name_key.encode("utf-8")).hexdigest()[:32]
+
+    async def download():
+        # Тот же трек мог скачивать другой процесс uvicorn: после ожидания блокировки проверяем хранилище еще раз
+        async with locks.file_lock(locks.striped("track", track_id)):
+            if (track := await database.find_track(shazam_result.get("key"), name_key)) and os.path.exists(track[1]):
+                cache.counters["track_hits"] += 1
+                return track[1]
+            cache.counters["track_downloads"] += 1
+            with metrics.stage("music_download"):
+                audio_file_path = await services.download_music(f"{artist} {title}", track_id)
+            if audio_file_path:
+                metrics.bytes_downloaded.inc(os.path.getsize(audio_file_path), kind="audio")
+                await database.save_track(track_id, name_key, shazam_result.get("key"), artist, title, audio_file_path)
+            return audio_file_path
+
+    return await track_downloads.run(track_id, download)
+
+async def lookup_music(cache_key: str) -> tuple | None:
+    """Ищет уже распознанный звук. Если MP3 был удален, скачивает его заново без повторного Shazam."""
+    cached = await database.get_music_cache(cache_key)
+    if not cached:
+        return None
+    shazam_result, audio_file_path, created_at = cached
+    if not shazam_result:
+        # Звук не распознан — не мучаем Shazam повторно, пока не истек срок
+        if created_at >= time.time() - config.MUSIC_NEGATIVE_TTL:
+            return None, None
+        return None
+    if audio_file_path and os.path.exists(audio_file_path):
+        eviction.touch(audio_file_path)
+        return shazam_result, audio_file_path
+
+    config.logger.info(f"Трек для {cache_key} известен, но файла нет. Беру его из хранилища треков.")
+    audio_file_path = await get_or_download_track(shazam_result)
+    await database.save_music_cache([cache_key], shazam_result, audio_file_path)
+    return shazam_result, audio_file_path
+
+async def recognize_music(video_file_path: str, music_id: str | None, shazam_instance) -> tuple:
+    """Возвращает (результат Shazam, путь к MP3). Сначала проверяет кэш по ID звука TikTok,
+    затем по хэшу аудиофрагмента, и только потом отправляет короткий фрагмент в Shazam."""
+    cache_keys = []
+    if music_id:
+        cache_keys.append(f"music:{music_id}")
+        if (hit := await lookup_music(cache_keys[0])) is not None:
+            cache.counters["music_hits"] += 1
+            config.logger.info(f"Звук {music_id} уже распознавался, Shazam пропущен.")
+            return hit
+
+    with metrics.stage("audio_extract"):
+        segment = await services.extract_audio_segment(video_file_path, config.AUDIO_SEGMENT_SECONDS, config.AUDIO_SEGMENT_OFFSET)
+    if segment:
+        audio_key = f"audio:{hashlib.sha1(segment).hexdigest()}"
+        if (hit := await lookup_music(audio_key)) is not None:
+            cache.counters["music_hits"] += 1
+            if cache_keys:
+                await database.save_music_cache(cache_keys, *hit)
+            return hit
+        cache_keys.append(audio_key)
+
+    cache.counters["music_misses"] += 1
+    # Если FFmpeg не справился, отдаем Shazam весь файл, как раньше
+    try:
+        with metrics.stage("shazam"):
+            shazam_result = await services.recognize_track(segment or video_file_path, shazam_instance)
+    except services.RecognitionError:
+        # Сбой Shazam не кэшируем как "не распознано": следующее видео с этим звуком попробует снова
+        return None, None
+    audio_file_path = await get_or_download_track(shazam_result) if shazam_result else None
+    if cache_keys:
+        await database.save_music_cache(cache_keys, shazam_result, audio_file_path)
+    return shazam_result, audio_file_path
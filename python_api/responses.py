@@ -0,0 +1,94 @@
+# python_api/responses.py
+
+import os
+import anyio
+from email.utils import formatdate, parsedate_to_datetime
+from fastapi import Request, Response
+from fastapi.responses import FileResponse, StreamingResponse
+
+CHUNK_SIZE = 256 * 1024
+
+class RangeNotSatisfiable(Exception):
+    """Диапазон байт корректен, но лежит за пределами файла."""
+
+def parse_range(range_header: str, file_size: int) -> tuple[int, int] | None:
+    """Разбирает заголовок Range с одним диапазоном. Возвращает (start, end) включительно.
+    None — заголовок нужно проигнорировать и отдать файл целиком (другие единицы, несколько диапазонов, ошибка синтаксиса)."""
+    unit, _, spec = range_header.partition("=")
+    if unit.strip().lower() != "bytes" or "," in spec:
+        return None
+    start_str, _, end_str = spec.strip().partition("-")
+    try:
+        if not start_str:
+            # Суффиксный диапазон: последние N байт
+            length = int(end_str)
+            if length < 0: return None
+            if length == 0 or file_size == 0: raise RangeNotSatisfiable()
+            return max(file_size - length, 0), file_size - 1
+        start = int(start_str)
+        end = int(end_str) if end_str else file_size - 1
+    except ValueError:
+        return None
+    if end_str and end < start:
+        return None
+    if start >= file_size:
+        raise RangeNotSatisfiable()
+    return start, min(end, file_size - 1)
+
+async def iter_file_range(path: str, start: int, end: int):
+    async with await anyio.open_file(path, "rb") as f:
+        await f.seek(start)
+        remaining = end - start + 1
+        while remaining > 0:
+            chunk = await f.read(min(CHUNK_SIZE, remaining))
+            if not chunk: break
+            remaining -= len(chunk)
+            yield chunk
+
+def is_not_modified(request: Request, etag: str, mtime: float) -> bool:
+    if if_none_match := request.headers.get("if-none-match"):
+        tags = [tag.strip() for tag in if_none_match.split(",")]
+        return "*" in tags or etag in tags or f"W/{etag}" in tags
+    if if_modified_since := request.headers.get("if-modified-since"):
+        try:
+            return int(mtime) <= parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return False
+    return False
+
+def file_response(request: Request, path: str, media_type: str, filename: str | None = None, headers: dict | None = None) -> Response:
+    """Отдает файл с поддержкой Range, ETag и Last-Modified.
+    Полный файл уходит через FileResponse, который использует zero-copy отправку, если ее поддерживает сервер."""
+    stat = os.stat(path)
+    etag = f'"{stat.st_mtime_ns:x}-{stat.st_size:x}"'
+    base_headers = {
+        "ETag": etag,
+        "Last-Modified": formatdate(stat.st_mtime, usegmt=True),
+        "Accept-Ranges": "bytes",
+        **(headers or {}),
+    }
+
+    if is_not_modified(request, etag, stat.st_mtime):
+        return Response(status_code=304, headers=base_headers)
+
+    range_header = request.headers.get("range")
+    if_range = request.headers.get("if-range")
+    if range_header and (not if_range or if_range in (etag, base_headers["Last-Modified"])):
+        try:
+            byte_range = parse_range(range_header, stat.st_size)
+        except RangeNotSatisfiable:
+            return Response(status_code=416, headers={**base_headers, "Content-Range": f"bytes */{stat.st_size}"})
+    else:
+        byte_range = None
+    if byte_range:
+        start, end = byte_range
+        range_headers = {
+            **base_headers,
+            "Content-Range": f"bytes {start}-{end}/{stat.st_size}",
+            "Content-Length": str(end - start + 1),
+        }
+        if filename:
+            range_headers["Content-Disposition"] = f'attachment; filename="{filename}"'
+        return StreamingResponse(iter_file_range(path, start, end), status_code=206, media_type=media_type, headers=range_headers)
+
+    return FileResponse(path=path, media_type=media_type, filename=filename, headers=base_headers, stat_result=stat)
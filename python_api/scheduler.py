@@ -0,0 +1,88 @@
+# python_api/scheduler.py
+
+import asyncio
+import time
+import metrics
+from config import logger
+
+class JobScheduler:
+    """Объединяет одновременные запросы к одному видео в одну задачу и ограничивает число параллельных задач."""
+
+    def __init__(self, max_concurrent: int, name: str = "posts"):
+        self.name = name
+        self.max_concurrent = max_concurrent
+        self._semaphore = asyncio.Semaphore(max_concurrent)
+        self._in_flight: dict[str, asyncio.Future] = {}
+        self._tasks = set()
+        # --- Метрики ---
+        self.waiting = 0
+        self.running = 0
+        self.coalesced = 0
+        self.completed = 0
+        self.failed = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    async def run(self, key: str, job_factory):
+        """Запускает job_factory() для ключа или присоединяется к уже идущей задаче с тем же ключом."""
+        future = self._in_flight.get(key)
+        if future is not None:
+            self.coalesced += 1
+            logger.info(f"Запрос для {key} присоединен к уже выполняющейся задаче.")
+        else:
+            future = asyncio.get_running_loop().create_future()
+            # Помечаем исключение как полученное, даже если все ожидающие ушли
+            future.add_done_callback(lambda f: f.cancelled() or f.exception())
+            self._in_flight[key] = future
+            # Задача живет отдельно от запроса: отключение клиента не отменит работу для остальных
+            task = asyncio.create_task(self._execute(key, job_factory, future))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+        return await asyncio.shield(future)
+
+    async def _execute(self, key: str, job_factory, future: asyncio.Future):
+        queued_at = time.monotonic()
+        try:
+            self.waiting += 1
+            try:
+                await self._semaphore.acquire()
+            finally:
+                self.waiting -= 1
+            wait = time.monotonic() - queued_at
+            metrics.queue_wait_seconds.observe(wait, queue=self.name)
+            self.total_wait += wait
+            self.max_wait = max(self.max_wait, wait)
+            self.running += 1
+            try:
+                result = await job_factory()
+            finally:
+                self.running -= 1
+                self._semaphore.release()
+        except asyncio.CancelledError:
+            self.failed += 1
+            future.cancel()
+            raise
+        except Exception as e:
+            self.failed += 1
+            if not future.done():
+                future.set_exception(e)
+        else:
+            self.completed += 1
+            if not future.done():
+                future.set_result(result)
+        finally:
+            self._in_flight.pop(key, None)
+
+    def stats(self) -> dict:
+        started = self.completed + self.failed + self.running
+        return {
+            "max_concurrent": self.max_concurrent,
+            "queue_depth": self.waiting,
+            "running": self.running,
+            "in_flight_keys": len(self._in_flight),
+            "coalesced": self.coalesced,
+            "completed": self.completed,
+            "failed": self.failed,
+            "avg_wait_seconds": round(self.total_wait / started, 4) if started else 0.0,
+            "max_wait_seconds": round(self.max_wait, 4),
+        }
@@ -1,57 +1,204 @@
 # python_api/services.py
 
+import asyncio
+import importlib.util
+import ipaddress
+import socket
 import httpx
+from http.cookiejar import CookieJar, DefaultCookiePolicy
 import tempfile
 import uuid
 import os
-import cv2
-from yt_dlp import YoutubeDL
-from shazamio import Shazam
-from TikTokApi import TikTokApi # <-- Важный импорт для подсказок типов
-from config import logger, YDL_OPTIONS, YOUTUBE_COOKIES, AUDIO_DIR
+from typing import TYPE_CHECKING
+import executors
+import config
+import metrics
+from config import logger, YDL_OPTIONS, YOUTUBE_COOKIES, AUDIO_DIR, DOWNLOAD_CHUNK_SIZE, DOWNLOAD_RETRIES, DOWNLOAD_RESUME
 
-async def resolve_short_url(url: str) -> str:
+# cv2, yt-dlp и shazamio импортируются при первом использовании: без них API стартует в разы быстрее,
+# а cv2 и yt-dlp чаще всего нужны только процессам пула
+if TYPE_CHECKING:
+    from shazamio import Shazam
+
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+class _RejectAllCookiesPolicy(DefaultCookiePolicy):
+    """Не сохраняет Set-Cookie из ответов: клиент общий, и куки одной сессии не должны уйти в чужие запросы."""
+    def set_ok(self, cookie, request) -> bool:
+        return False
+
+# --- Общий HTTP-клиент на все время жизни приложения ---
+def create_http_client() -> httpx.AsyncClient:
+    """Создает клиент с пулом keep-alive соединений и HTTP/2 (если установлен пакет h2)."""
+    http2 = config.HTTP2_ENABLED
+    if http2 and importlib.util.find_spec("h2") is None:
+        logger.warning("Пакет h2 не установлен, HTTP/2 отключен. Установите httpx[http2].")
+        http2 = False
+    return httpx.AsyncClient(
+        http2=http2,
+        follow_redirects=True,
+        # Куки сессий передаются явно в каждом запросе, общий jar остается пустым
+        cookies=CookieJar(policy=_RejectAllCookiesPolicy()),
+        limits=httpx.Limits(
+            max_connections=config.HTTP_MAX_CONNECTIONS,
+            max_keepalive_connections=config.HTTP_MAX_KEEPALIVE,
+            keepalive_expiry=config.HTTP_KEEPALIVE_EXPIRY,
+        ),
+        timeout=httpx.Timeout(config.HTTP_TIMEOUT, connect=config.HTTP_CONNECT_TIMEOUT),
+    )
+
+async def request_with_retry(client: httpx.AsyncClient, method: str, url: str, **kwargs) -> httpx.Response:
+    """Выполняет запрос, повторяя его с экспоненциальной задержкой при сетевых ошибках и ответах 429/5xx."""
+    for attempt in range(config.HTTP_RETRIES + 1):
+        is_last = attempt == config.HTTP_RETRIES
+        try:
+            response = await client.request(method, url, **kwargs)
+            if response.status_code not in RETRY_STATUS_CODES or is_last:
+                return response
+            logger.warning(f"{method} {url} вернул {response.status_code}, попытка {attempt + 2}.")
+        except httpx.TransportError as e:
+            if is_last: raise
+            logger.warning(f"Сетевая ошибка {method} {url}: {e}, попытка {attempt + 2}.")
+        await asyncio.sleep(config.HTTP_BACKOFF * 2 ** attempt)
+
+async def check_callback_url(url: str):
+    """Проверяет адрес уведомления о задаче, чтобы через /jobs нельзя было слать запросы во внутреннюю сеть.
+    Разрешены только http(s) и хосты из JOB_CALLBACK_ALLOWED_HOSTS, а если список пуст — хосты с публичными адресами.
+    Бросает ValueError с причиной отказа."""
+    try:
+        parsed = httpx.URL(url)
+    except httpx.InvalidURL:
+        raise ValueError("Некорректный адрес уведомления.")
+    if parsed.scheme not in ("http", "https") or not parsed.host:
+        raise ValueError("Адрес уведомления должен начинаться с http:// или https://.")
+    host = parsed.host.lower()
+    if config.JOB_CALLBACK_ALLOWED_HOSTS:
+        if host not in config.JOB_CALLBACK_ALLOWED_HOSTS:
+            raise ValueError(f"Хост {host} не входит в список разрешенных для уведомлений.")
+        return
+    try:
+        addresses = await asyncio.get_running_loop().getaddrinfo(host, parsed.port or 443, type=socket.SOCK_STREAM)
+    except socket.gaierror:
+        raise ValueError(f"Не удалось найти хост {host}.")
+    for *_, sockaddr in addresses:
+        address = ipaddress.ip_address(sockaddr[0].split("%")[0])
+        if address.version == 6 and address.ipv4_mapped:
+            address = address.ipv4_mapped
+        if not address.is_global:
+            raise ValueError("Уведомления на внутренние адреса запрещены.")
+
+async def resolve_short_url(url: str, client: httpx.AsyncClient) -> str:
     """Раскрывает короткие ссылки TikTok."""
     if "tiktok.com" in url:
         try:
-            async with httpx.AsyncClient(follow_redirects=True, timeout=10.0) as client:
-                response = await client.head(url)
-                final_url = str(response.url).split("?")[0]
-                logger.info(f"Ссылка {url} раскрыта в {final_url}")
-                return final_url
+            response = await request_with_retry(client, "HEAD", url, timeout=10.0)
+            final_url = str(response.url).split("?")[0]
+            logger.info(f"Ссылка {url} раскрыта в {final_url}")
+            return final_url
         except httpx.RequestError:
             return url.split("?")[0]
     return url.split("?")[0]
 
-async def download_image_simple(url: str, path: str):
-    """Надежно скачивает изображения для альбомов."""
+# --- Ограничение одновременных загрузок с одного хоста (CDN TikTok режет слишком частые запросы) ---
+_host_semaphores = {}
+
+def host_semaphore(url: str) -> asyncio.Semaphore:
+    host = httpx.URL(url).host
+    if host not in _host_semaphores:
+        _host_semaphores[host] = asyncio.Semaphore(config.IMAGE_HOST_CONCURRENCY)
+    return _host_semaphores[host]
+
+async def download_image(url: str, path: str, client: httpx.AsyncClient, max_bytes: int | None = None) -> int:
+    """Потоково скачивает изображение альбома во временный файл и атомарно переименовывает его.
+    Возвращает размер файла в байтах; при ошибке удаляет временный файл и пробрасывает исключение."""
+    tmp_path = f"{path}.part"
     try:
-        async with httpx.AsyncClient(follow_redirects=True, timeout=30.0) as client:
-            r = await client.get(url)
-            r.raise_for_status()
-            with open(path, "wb") as f:
-                f.write(r.content)
+        async with host_semaphore(url):
+            for attempt in range(config.HTTP_RETRIES + 1):
+                size = 0
+                try:
+                    async with client.stream("GET", url, headers={'Referer': 'https://www.tiktok.com/'}, timeout=30.0) as r:
+                        r.raise_for_status()
+                        with open(tmp_path, "wb") as f:
+                            async for chunk in r.aiter_bytes(DOWNLOAD_CHUNK_SIZE):
+                                await executors.run_io(f.write, chunk)
+                                size += len(chunk)
+                                if max_bytes and size > max_bytes:
+                                    raise DownloadTooLargeError(f"Размер изображения превышает лимит {max_bytes} байт.")
+                    break
+                except (httpx.TransportError, httpx.HTTPStatusError) as e:
+                    retryable = not isinstance(e, httpx.HTTPStatusError) or e.response.status_code in RETRY_STATUS_CODES
+                    if attempt == config.HTTP_RETRIES or not retryable:
+                        raise
+                    await asyncio.sleep(config.HTTP_BACKOFF * 2 ** attempt)
+        os.replace(tmp_path, path)
+        metrics.bytes_downloaded.inc(size, kind="image")
+        return size
     except Exception as e:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
         logger.error(f"Ошибка при скачивании изображения {url}: {e}")
+        raise
+
+class DownloadTooLargeError(Exception):
+    """Файл превышает допустимый размер для скачивания."""
 
 # ✅ ✅ ✅ ВОТ НЕДОСТАЮЩАЯ ФУНКЦИЯ ✅ ✅ ✅
-async def download_video_with_session(url: str, api: TikTokApi) -> bytes:
-    """Надежно скачивает видео по прямой ссылке, используя активную сессию TikTokApi."""
+async def download_video_with_session(url: str, dest_path: str, client: httpx.AsyncClient, headers: dict, cookies: dict, max_bytes: int | None = None) -> int:
+    """Потоково скачивает видео с заголовками и cookies сессии TikTok (см. sessions.SessionPool.download_context)
+    во временный файл рядом с dest_path и атомарно переименовывает его.
+    При обрыве соединения докачивает недостающую часть через Range. Возвращает размер файла в байтах."""
+    tmp_path = f"{dest_path}.part"
     try:
-        _ , session = api._get_session()
-        cookies = await api.get_session_cookies(session)
-        headers = {**session.headers, 'Referer': 'https://www.tiktok.com/'}
-        
-        async with httpx.AsyncClient(timeout=60.0, follow_redirects=True) as client:
-            r = await client.get(url, headers=headers, cookies=cookies)
-            r.raise_for_status()
-            return r.content
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+        for attempt in range(DOWNLOAD_RETRIES + 1):
+            downloaded = os.path.getsize(tmp_path) if os.path.exists(tmp_path) else 0
+            request_headers = dict(headers)
+            if downloaded and DOWNLOAD_RESUME:
+                request_headers['Range'] = f'bytes={downloaded}-'
+            try:
+                async with client.stream("GET", url, headers=request_headers, cookies=cookies, timeout=60.0) as r:
+                    r.raise_for_status()
+                    # Сервер проигнорировал Range или докачка выключена — начинаем файл заново
+                    if r.status_code != 206 or not r.headers.get('Content-Range', '').startswith(f'bytes {downloaded}-'):
+                        downloaded = 0
+                    expected = int(r.headers.get('Content-Length', 0)) + downloaded
+                    if max_bytes and expected > max_bytes:
+                        raise DownloadTooLargeError(f"Размер видео {expected} байт превышает лимит {max_bytes} байт.")
+                    with open(tmp_path, "ab" if downloaded else "wb") as f:
+                        async for chunk in r.aiter_bytes(DOWNLOAD_CHUNK_SIZE):
+                            await executors.run_io(f.write, chunk)
+                            downloaded += len(chunk)
+                            if max_bytes and downloaded > max_bytes:
+                                raise DownloadTooLargeError(f"Размер видео превышает лимит {max_bytes} байт.")
+                break
+            except (httpx.TransportError, httpx.HTTPStatusError) as e:
+                retryable = not isinstance(e, httpx.HTTPStatusError) or e.response.status_code in RETRY_STATUS_CODES
+                if attempt == DOWNLOAD_RETRIES or not retryable:
+                    raise
+                logger.warning(f"Обрыв при скачивании видео ({downloaded} байт получено), попытка {attempt + 2}: {e}")
+                await asyncio.sleep(config.HTTP_BACKOFF * 2 ** attempt)
+
+        os.replace(tmp_path, dest_path)
+        metrics.bytes_downloaded.inc(downloaded, kind="video")
+        return downloaded
     except Exception as e:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
         logger.error(f"Ошибка при скачивании видеофайла по ссылке {url}: {e}", exc_info=True)
         raise
 
-def get_video_details(file_path: str) -> dict:
-    """Возвращает разрешение, FPS и размер видеофайла."""
+def write_file(path: str, data: bytes):
+    with open(path, "wb") as f:
+        f.write(data)
+
+# --- Синхронные функции ниже выполняются в пуле процессов (см. executors.py) ---
+def probe_video_sync(file_path: str, thumb_dir: str, sizes: list, webp: bool) -> dict:
+    """Открывает видео один раз: возвращает разрешение, FPS и размер и сохраняет миниатюры первого кадра.
+    Миниатюры пишутся в thumb_dir как <ширина>.jpg (и .webp); ширина 0 — исходный размер кадра."""
+    import cv2
     try:
         cap = cv2.VideoCapture(file_path)
         details = {
@@ -59,34 +206,128 @@ def get_video_details(file_path: str) -> dict:
             "fps": round(cap.get(cv2.CAP_PROP_FPS)),
             "size_mb": f"{os.path.getsize(file_path) / (1024 * 1024):.2f} MB"
         }
+        success, frame = cap.read()
         cap.release()
-        return details
     except Exception as e:
         logger.error(f"Не удалось получить детали видео {file_path}: {e}")
         return {}
+    if not success:
+        logger.warning(f"Не удалось извлечь кадр из видео {file_path}.")
+        return details
+
+    os.makedirs(thumb_dir, exist_ok=True)
+    height, width = frame.shape[:2]
+    formats = [("jpg", [cv2.IMWRITE_JPEG_QUALITY, 85])] + ([("webp", [cv2.IMWRITE_WEBP_QUALITY, 80])] if webp else [])
+    for size in sizes:
+        image = frame
+        if size and width > size:
+            image = cv2.resize(frame, (size, round(height * size / width)), interpolation=cv2.INTER_AREA)
+        for ext, params in formats:
+            success, buffer = cv2.imencode(f".{ext}", image, params)
+            if success:
+                thumb_path = os.path.join(thumb_dir, f"{size}.{ext}")
+                # Одно старое видео могут разбирать несколько запросов сразу: у каждого свой временный файл
+                temp_path = f"{thumb_path}.{uuid.uuid4().hex}.tmp"
+                write_file(temp_path, buffer.tobytes())
+                os.replace(temp_path, thumb_path)
+    return details
+
+def prepare_image_sync(path: str, reencode: bool, max_side: int, max_bytes: int, quality: int) -> dict:
+    """Проверяет, что изображение читается, и возвращает его размеры.
+    С reencode=True пережимает в JPEG, если фото не JPEG, больше max_side или тяжелее max_bytes."""
+    import cv2
+    image = cv2.imread(path, cv2.IMREAD_COLOR)
+    if image is None:
+        raise ValueError("Файл не является изображением.")
+    height, width = image.shape[:2]
+    size = os.path.getsize(path)
+    with open(path, "rb") as f:
+        is_jpeg = f.read(3) == b"\xff\xd8\xff"
+    if reencode and (not is_jpeg or max(width, height) > max_side or size > max_bytes):
+        if max(width, height) > max_side:
+            scale = max_side / max(width, height)
+            width, height = round(width * scale), round(height * scale)
+            image = cv2.resize(image, (width, height), interpolation=cv2.INTER_AREA)
+        # Снижаем качество, пока файл не уложится в лимит
+        while True:
+            success, buffer = cv2.imencode(".jpg", image, [cv2.IMWRITE_JPEG_QUALITY, quality])
+            if not success:
+                raise ValueError("Не удалось пережать изображение.")
+            if buffer.nbytes <= max_bytes or quality <= 50:
+                break
+            quality -= 10
+        write_file(f"{path}.tmp", buffer.tobytes())
+        os.replace(f"{path}.tmp", path)
+        size = buffer.nbytes
+    return {"width": width, "height": height, "size": size}
+
+async def prepare_image(path: str) -> dict:
+    return await executors.run_cpu(
+        prepare_image_sync, path, config.IMAGE_REENCODE, config.IMAGE_MAX_SIDE,
+        config.TELEGRAM_PHOTO_MAX_BYTES, config.IMAGE_JPEG_QUALITY,
+    )
+
+async def probe_video(file_path: str, thumb_dir: str) -> dict:
+    try:
+        return await executors.run_cpu(probe_video_sync, file_path, thumb_dir, config.THUMBNAIL_SIZES, config.THUMBNAIL_WEBP)
+    except Exception as e:
+        logger.error(f"Не удалось обработать видео {file_path}: {e}")
+        return {}
 
+async def extract_audio_segment(video_file_path: str, seconds: float, offset: float = 0) -> bytes | None:
+    """Вырезает короткий моно-фрагмент звука (WAV, 16 кГц) через FFmpeg. Этого достаточно для Shazam."""
+    try:
+        process = await asyncio.create_subprocess_exec(
+            "ffmpeg", "-v", "error", "-ss", str(offset), "-t", str(seconds), "-i", video_file_path,
+            "-vn", "-ac", "1", "-ar", "16000", "-f", "wav", "pipe:1",
+            stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE,
+        )
+        stdout, stderr = await asyncio.wait_for(process.communicate(), timeout=60)
+        # 44 байта — это пустой WAV без звука
+        if process.returncode == 0 and len(stdout) > 44:
+            return stdout
+        logger.warning(f"FFmpeg не извлек звук из {video_file_path}: {stderr.decode(errors='ignore').strip()}")
+    except (OSError, asyncio.TimeoutError) as e:
+        logger.warning(f"Не удалось извлечь звук из {video_file_path}: {e}")
+    return None
+
+class RecognitionError(Exception):
+    """Shazam не ответил (сеть, лимит запросов, ошибка разбора). В отличие от None, это не значит, что трека нет."""
 
-async def recognize_and_download_shazam(video_bytes: bytes, shazam_instance: Shazam) -> tuple:
-    """Распознает музыку в видео и скачивает ее."""
+def create_shazam() -> "Shazam":
+    from shazamio import Shazam
+    return Shazam()
+
+async def recognize_track(audio: str | bytes, shazam_instance: "Shazam") -> dict | None:
+    """Распознает музыку (путь к файлу или байты аудио). Возвращает исполнителя, название и ключ трека Shazam
+    или None, если Shazam ничего не нашел. При сбое самого Shazam бросает RecognitionError."""
     try:
-        recognition = await shazam_instance.recognize(video_bytes)
-        if track := recognition.get('track'):
-            shazam_result = { "artist": track.get('subtitle', 'Неизвестен'), "title": track.get('title', 'Неизвестно') }
-            if shazam_result["title"] != 'Неизвестно':
-                search_query = f"{shazam_result.get('artist', '')} {shazam_result.get('title', '')}"
-                audio_file_path = await download_music(search_query)
-                return shazam_result, audio_file_path
+        recognition = await shazam_instance.recognize(audio)
     except Exception as e:
         logger.warning(f"Ошибка Shazam: {e}")
-    return None, None
+        raise RecognitionError(str(e) or type(e).__name__) from e
+    if track := recognition.get('track'):
+        shazam_result = { "artist": track.get('subtitle', 'Неизвестен'), "title": track.get('title', 'Неизвестно'), "key": track.get('key') }
+        if shazam_result["title"] != 'Неизвестно':
+            return shazam_result
+    return None
+
+async def download_music(search_query: str, music_file_id: str | None = None) -> str | None:
+    """Скачивает музыку с YouTube в отдельном процессе, не блокируя event loop."""
+    try:
+        return await executors.run_music(download_music_sync, search_query, music_file_id)
+    except Exception as e:
+        logger.error(f"Ошибка при скачивании музыки: {e}", exc_info=True)
+        return None
 
-async def download_music(search_query: str) -> str | None:
-    """Скачивает музыку с YouTube."""
+def download_music_sync(search_query: str, music_file_id: str | None = None) -> str | None:
+    """Скачивает музыку с YouTube в AUDIO_DIR/<music_file_id>.mp3."""
+    from yt_dlp import YoutubeDL
     cookie_file = tempfile.NamedTemporaryFile(mode='w', delete=False, suffix='.txt', encoding='utf-8')
     try:
         cookie_file.write(YOUTUBE_COOKIES.strip())
         cookie_file.close()
-        music_file_id = str(uuid.uuid4())
+        music_file_id = music_file_id or str(uuid.uuid4())
         audio_path = os.path.abspath(os.path.join(AUDIO_DIR, f"{music_file_id}.mp3"))
         ydl_opts = YDL_OPTIONS.copy()
         ydl_opts['cookiefile'] = cookie_file.name
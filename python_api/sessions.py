@@ -0,0 +1,318 @@
+# python_api/sessions.py
+
+import asyncio
+import json
+import time
+import httpx
+import config
+from config import logger
+
+def create_api():
+    # TikTokApi тянет за собой Playwright — импортируем его только при запуске пула
+    from TikTokApi import TikTokApi
+    return TikTokApi()
+
+class SessionUnavailableError(Exception):
+    """Нет ни одной рабочей сессии TikTok."""
+
+class PostUnavailableError(Exception):
+    """TikTok отдал страницу, но сообщил ненулевым statusCode, что пост удален, приватный или недоступен в регионе."""
+
+    def __init__(self, video_id: str, status_code: int):
+        self.status_code = status_code
+        super().__init__(f"Пост {video_id} недоступен, statusCode {status_code}")
+
+def is_session_error(error: Exception) -> bool:
+    """Сбой браузера, сети или самой сессии (капча, блокировка, пустые ответы). Остальное — ответ TikTok про конкретный
+    пост (PostUnavailableError, NotFoundException, 404). Такие ошибки другая сессия не исправит, и сессию они не портят."""
+    from playwright.async_api import Error as PlaywrightError
+    from TikTokApi.exceptions import CaptchaException, EmptyResponseException, InvalidJSONException, InvalidResponseException
+    if isinstance(error, InvalidResponseException):
+        # 403, 429, 5xx и страница без данных: TikTok не отдал пост этой сессии, другая может получить его
+        code = error.error_code
+        return not (isinstance(code, int) and 400 <= code < 500 and code not in (403, 429))
+    # OSError — сетевые ошибки, которые не обернуты в httpx.TransportError
+    return isinstance(error, (PlaywrightError, CaptchaException, EmptyResponseException, InvalidJSONException,
+                              httpx.TransportError, OSError, asyncio.TimeoutError))
+
+def extract_video_data(html: str, video_id: str, status_code: int) -> dict:
+    """Данные видео из страницы поста: те же скрипты SIGI_STATE и __UNIVERSAL_DATA_FOR_REHYDRATION__,
+    что разбирает video.info() в TikTokApi 7.x. Недоступный пост — PostUnavailableError, страница без данных — InvalidResponseException."""
+    from TikTokApi.exceptions import InvalidResponseException
+    for script_id in ("SIGI_STATE", "__UNIVERSAL_DATA_FOR_REHYDRATION__"):
+        start = html.find(f'<script id="{script_id}" type="application/json">')
+        if start == -1:
+            continue
+        start = html.index(">", start) + 1
+        end = html.find("</script>", start)
+        try:
+            data = json.loads(html[start:end]) if end != -1 else None
+        except ValueError:
+            data = None
+        if not isinstance(data, dict):
+            break
+        if script_id == "SIGI_STATE":
+            video_info = (data.get("ItemModule") or {}).get(video_id)
+        else:
+            video_detail = (data.get("__DEFAULT_SCOPE__") or {}).get("webapp.video-detail") or {}
+            if video_detail.get("statusCode", 0) != 0:
+                raise PostUnavailableError(video_id, video_detail["statusCode"])
+            video_info = (video_detail.get("itemInfo") or {}).get("itemStruct")
+        if video_info is None:
+            raise InvalidResponseException(html, "TikTok returned an invalid response structure.", error_code=status_code)
+        return video_info
+    raise InvalidResponseException(html, "TikTok returned an invalid response.", error_code=status_code)
+
+class PooledSession:
+    """Сессия Playwright и ее счетчики нагрузки и ошибок."""
+
+    def __init__(self, ms_token: str):
+        self.ms_token = ms_token
+        self.session = None
+        self.healthy = False
+        self.in_flight = 0
+        self.requests = 0
+        self.failures = 0
+        self.recreated = 0
+        self.created_at = 0
+        self.last_error = None
+        self.cookies = None
+        self.cookies_at = 0.0
+
+    def as_dict(self, index: int) -> dict:
+        return {
+            "index": index,
+            "token": f"...{self.ms_token[-6:]}",
+            "healthy": self.healthy,
+            "in_flight": self.in_flight,
+            "requests": self.requests,
+            "failures": self.failures,
+            "recreated": self.recreated,
+            "age_seconds": int(time.time() - self.created_at) if self.created_at else None,
+            "last_error": self.last_error,
+        }
+
+class SessionPool:
+    """Несколько сессий TikTokApi на одном браузере: запрос уходит в наименее загруженную рабочую сессию,
+    сломавшиеся сессии пересоздаются с тем же ms_token в фоне."""
+
+    def __init__(self, ms_tokens: list, sessions_per_token: int, http_client: httpx.AsyncClient):
+        self.api = None
+        self._http = http_client
+        self._sessions = [PooledSession(token) for token in ms_tokens for _ in range(sessions_per_token)]
+        self._create_lock = asyncio.Lock()
+        self._recreating = set()
+        self._ready = asyncio.Event()
+        self._warmup_task = None
+        self._health_task = None
+
+    async def start(self):
+        """Запускает браузер и сессии в фоне: API принимает запросы сразу, а обращения к TikTok ждут прогрева."""
+        self._warmup_task = asyncio.create_task(self._warm_up())
+
+    async def _warm_up(self):
+        while True:
+            try:
+                self.api = create_api()
+                # Запускаем только браузер, сессии создаем сами, чтобы токены распределились равномерно
+                await self.api.create_sessions(
+                    num_sessions=0, ms_tokens=[pooled.ms_token for pooled in self._sessions],
+                    sleep_after=config.TIKTOK_SLEEP_AFTER, headless=True, browser="chromium",
+                )
+                break
+            except Exception as e:
+                logger.error(f"Не удалось запустить браузер для TikTok: {e}. Повтор через {config.TIKTOK_HEALTH_INTERVAL} сек.")
+                self.api = None
+                self._ready.set()
+                await asyncio.sleep(config.TIKTOK_HEALTH_INTERVAL)
+        for pooled in self._sessions:
+            await self._recreate(pooled)
+        healthy = sum(pooled.healthy for pooled in self._sessions)
+        if not healthy:
+            logger.error("Не удалось создать ни одной сессии TikTok! Повторю попытку при следующей проверке.")
+        logger.info(f"Сессий TikTok: {healthy} из {len(self._sessions)}.")
+        self._ready.set()
+        self._health_task = asyncio.create_task(self._health_loop())
+
+    async def stop(self):
+        for task in (self._warmup_task, self._health_task):
+            if task:
+                task.cancel()
+                await asyncio.gather(task, return_exceptions=True)
+        if self.api:
+            await self.api.close_sessions()
+
+    @property
+    def is_ready(self) -> bool:
+        return any(pooled.healthy for pooled in self._sessions)
+
+    async def _wait_ready(self):
+        if self._ready.is_set():
+            return
+        try:
+            await asyncio.wait_for(self._ready.wait(), config.TIKTOK_WARMUP_WAIT)
+        except asyncio.TimeoutError:
+            raise SessionUnavailableError("Сессии TikTok еще запускаются, попробуйте позже.")
+
+    # --- Выбор сессии и выполнение запроса ---
+    def _pick(self, exclude: set) -> PooledSession:
+        candidates = [pooled for pooled in self._sessions if pooled.healthy and id(pooled) not in exclude]
+        if not candidates:
+            raise SessionUnavailableError("Нет рабочих сессий TikTok.")
+        return min(candidates, key=lambda pooled: (pooled.in_flight, pooled.requests))
+
+    async def _call(self, request) -> tuple:
+        """Выполняет request(session_index) в наименее загруженной сессии. При сбое сессии один раз пробует другую.
+        Возвращает (результат, сессия)."""
+        await self._wait_ready()
+        tried = set()
+        while True:
+            pooled = self._pick(tried)
+            tried.add(id(pooled))
+            if pooled.session not in self.api.sessions:
+                # Библиотека сама удалила мертвую сессию из списка
+                pooled.last_error = "Сессия удалена из TikTokApi"
+                self._mark_broken(pooled)
+                continue
+            pooled.in_flight += 1
+            pooled.requests += 1
+            try:
+                result = await request(self.api.sessions.index(pooled.session))
+                pooled.failures = 0
+                return result, pooled
+            except Exception as e:
+                if not is_session_error(e):
+                    # Сессия ответила, значит она рабочая; повтор через другую сессию даст тот же ответ
+                    pooled.failures = 0
+                    raise
+                self._record_failure(pooled, e)
+                if len(tried) >= 2 or not any(p.healthy and id(p) not in tried for p in self._sessions):
+                    raise
+                logger.warning(f"Запрос через сессию TikTok не удался ({e}), пробую другую сессию.")
+            finally:
+                pooled.in_flight -= 1
+
+    def _record_failure(self, pooled: PooledSession, error: Exception):
+        pooled.failures += 1
+        pooled.last_error = str(error) or type(error).__name__
+        if pooled.failures >= config.TIKTOK_MAX_FAILURES:
+            self._mark_broken(pooled)
+
+    def _mark_broken(self, pooled: PooledSession):
+        pooled.healthy = False
+        self._schedule_recreate(pooled)
+
+    async def video_info(self, url: str, video_id: str) -> tuple:
+        """Метаданные видео по ссылке. Возвращает (данные, сессия)."""
+        return await self._call(lambda index: self._fetch_video_info(url, video_id, index))
+
+    async def _fetch_video_info(self, url: str, video_id: str, index: int) -> dict:
+        """Замена video.info() из TikTokApi: библиотека загружает страницу синхронным requests.get прямо в event loop,
+        и на это время замирают все остальные запросы. Здесь страница загружается общим асинхронным клиентом."""
+        from TikTokApi.exceptions import InvalidResponseException
+        from TikTokApi.helpers import requests_cookie_to_playwright_cookie
+        session = self.api.sessions[index]
+        response = await self._http.get(url, headers=session.headers or {})
+        if response.status_code != 200:
+            raise InvalidResponseException(response.text, "TikTok returned an invalid response.", error_code=response.status_code)
+        video_info = extract_video_data(response.text, video_id, response.status_code)
+        # Как и библиотека, передаем cookies страницы в браузерную сессию
+        if cookies := [requests_cookie_to_playwright_cookie(cookie) for cookie in response.cookies.jar]:
+            await self.api.set_session_cookies(session, cookies)
+        return video_info
+
+    async def item_detail(self, item_id: str) -> tuple:
+        """Прямой запрос к /api/item/detail/ (нужен для фотоальбомов). Возвращает (ответ, сессия)."""
+        return await self._call(lambda index: self.api.make_request(
+            url="https://www.tiktok.com/api/item/detail/", params={"itemId": item_id}, session_index=index
+        ))
+
+    async def feed_videos(self, kind: str, value: str, count: int) -> list:
+        """Посты из ленты автора (kind="user"), хэштега ("hashtag") или звука ("music"). Возвращает список данных постов."""
+        async def request(index: int) -> list:
+            if kind == "user":
+                feed = self.api.user(username=value)
+            elif kind == "hashtag":
+                feed = self.api.hashtag(name=value)
+            else:
+                feed = self.api.sound(id=value)
+            # Лента отдается страницами по 30 постов, последняя страница может дать лишние
+            items = [video.as_dict async for video in feed.videos(count=count, session_index=index)]
+            return items[:count]
+        items, _ = await self._call(request)
+        return items
+
+    async def download_context(self, pooled: PooledSession) -> tuple[dict, dict]:
+        """Заголовки и cookies сессии для скачивания с CDN. Cookies берутся из браузера не чаще раза в TIKTOK_COOKIE_TTL."""
+        if pooled.cookies is None or time.monotonic() - pooled.cookies_at > config.TIKTOK_COOKIE_TTL:
+            pooled.cookies = await self.api.get_session_cookies(pooled.session)
+            pooled.cookies_at = time.monotonic()
+        headers = {**(pooled.session.headers or {}), 'Referer': 'https://www.tiktok.com/'}
+        return headers, pooled.cookies
+
+    # --- Проверка и пересоздание сессий ---
+    def _schedule_recreate(self, pooled: PooledSession):
+        if id(pooled) in self._recreating: return
+        self._recreating.add(id(pooled))
+        task = asyncio.create_task(self._recreate(pooled))
+        task.add_done_callback(lambda _: self._recreating.discard(id(pooled)))
+
+    async def _recreate(self, pooled: PooledSession):
+        pooled.healthy = False
+        # Закрытая сессия остается в списке TikTokApi до замены: запросы обращаются к сессиям по индексу,
+        # и удаление сдвинуло бы индексы остальных сессий посреди их запросов
+        if old := pooled.session:
+            for resource in (old.page, old.context):
+                try:
+                    await resource.close()
+                except Exception:
+                    pass
+        try:
+            async with self._create_lock:
+                # Отдельная сессия в уже запущенном браузере. Публичный create_sessions каждый раз запускает новый браузер,
+                # поэтому используем внутренний метод TikTokApi 7.x
+                await self.api._TikTokApi__create_session(ms_token=pooled.ms_token, sleep_after=config.TIKTOK_SLEEP_AFTER)
+                # Новая сессия занимает место старой
+                new = self.api.sessions.pop()
+                if old is not None and old in self.api.sessions:
+                    self.api.sessions[self.api.sessions.index(old)] = new
+                else:
+                    self.api.sessions.append(new)
+                pooled.session = new
+        except Exception as e:
+            pooled.last_error = str(e) or type(e).__name__
+            logger.error(f"Не удалось создать сессию TikTok с токеном ...{pooled.ms_token[-6:]}: {e}")
+            return
+        if pooled.created_at:
+            pooled.recreated += 1
+            logger.info(f"Сессия TikTok с токеном ...{pooled.ms_token[-6:]} пересоздана.")
+        pooled.created_at = time.time()
+        pooled.failures = 0
+        pooled.cookies = None
+        pooled.healthy = True
+
+    async def _probe(self, pooled: PooledSession) -> bool:
+        try:
+            await asyncio.wait_for(pooled.session.page.evaluate("() => document.readyState"), config.TIKTOK_PROBE_TIMEOUT)
+            return True
+        except Exception as e:
+            pooled.last_error = str(e) or type(e).__name__
+            return False
+
+    async def _health_loop(self):
+        while True:
+            await asyncio.sleep(config.TIKTOK_HEALTH_INTERVAL)
+            for pooled in self._sessions:
+                if id(pooled) in self._recreating:
+                    continue
+                if pooled.session is None or not await self._probe(pooled):
+                    logger.warning(f"Сессия TikTok с токеном ...{pooled.ms_token[-6:]} не отвечает, пересоздаю.")
+                    self._schedule_recreate(pooled)
+
+    def stats(self) -> dict:
+        return {
+            "warming_up": not self._ready.is_set(),
+            "total": len(self._sessions),
+            "healthy": sum(pooled.healthy for pooled in self._sessions),
+            "sessions": [pooled.as_dict(index) for index, pooled in enumerate(self._sessions)],
+        }